@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark hot paths on a synthetic STRING DB format corpus.
+
+Generates database_documents.tsv and all_matches.tsv files with
+escapes, non-ASCII text, tab-separated sections, overlapping spans
+of several types and COG/KOG serials, then times readers, parsing,
+span comparison and offset mapping. Each benchmark runs in a separate
+process to measure its peak RSS. Results are saved in JSON format
+and can be compared against previously saved results.
+"""
+
+import sys
+import os
+import json
+import time
+import random
+import resource
+import multiprocessing
+
+from argparse import ArgumentParser, Namespace
+
+from common import DocReader, SpanReader, StringSpan, stringdb_escape_text
+from common import stringdb_unescape_text
+
+
+# Documents and spans per source for nested span worst case
+NESTED_DOCS = 5
+NESTED_SPANS = 300
+
+
+DOC_FN = 'database_documents.tsv'
+TAG_FNS = ['all_matches.tsv', 'all_matches2.tsv']
+CHAR_TAG_FN = 'all_matches_char.tsv'
+
+
+WORDS = [
+    'the', 'of', 'and', 'in', 'protein', 'expression', 'cells', 'was',
+    'were', 'with', 'binding', 'activity', 'levels', 'patients', 'mice',
+    'observed', 'increased', 'significantly', 'pathway', 'receptor',
+    'naïve', 'Müller', 'α-helix', 'β-catenin', '5′-UTR', 'µM', '±',
+    'C:\\path', 'a\\b', '→', 'IL-6/STAT3', '(p<0.05)', 'Ca²⁺', '中文',
+]
+
+
+# (name, tagger type, serials), nested names produce overlapping spans
+ENTITIES = [
+    ('BRCA1', '9606', 'ENSP00000350283,KOG4362'),
+    ('BRCA1 protein', '9606', 'ENSP00000350283'),
+    ('p53', '9606', 'ENSP00000269305,COG5047'),
+    ('TNF-α', '9606', 'ENSP00000398698'),
+    ('Tnf', '10090', 'ENSMUSP00000025263'),
+    ('insulin', '9606', 'ENSP00000381601'),
+    ('insulin', '-1', 'CIDs00016129'),
+    ('caffeine', '-1', 'CIDm00002519'),
+    ('β-carotene', '-1', 'CIDs05280489'),
+    ('Homo sapiens', '-2', '9606'),
+    ('human', '-2', '9606'),
+    ('Mus musculus', '-3', '10090'),
+    ('breast cancer', '-26', 'DOID:1612'),
+    ('cancer', '-26', 'DOID:162'),
+    ('apoptosis', '-21', 'GO:0006915'),
+    ('liver', '-25', 'BTO:0000759'),
+]
+
+
+def argparser():
+    ap = ArgumentParser()
+    ap.add_argument('--dir', default='benchmark-data',
+                    help='directory for synthetic corpus')
+    ap.add_argument('--docs', default=10000, type=int,
+                    help='number of documents to generate')
+    ap.add_argument('--seed', default=0, type=int, help='random seed')
+    ap.add_argument('--regenerate', default=False, action='store_true',
+                    help='regenerate corpus even if it exists')
+    ap.add_argument('--generate-only', default=False, action='store_true')
+    ap.add_argument('--only', default=None,
+                    help='comma-separated names of benchmarks to run')
+    ap.add_argument('--output', default='benchmark-results.json',
+                    help='file to save results in')
+    ap.add_argument('--compare', default=None, metavar='JSON',
+                    help='compare to previously saved results')
+    ap.add_argument('--check', default=False, action='store_true',
+                    help='check that --one-to-one agrees with the default '
+                    'comparison')
+    return ap
+
+
+def generate_section(rng, min_words, max_words):
+    """Return (text, [(start, end, name, type, serials)]) with
+    end-exclusive character offsets."""
+    tokens, entities = [], []
+    for i in range(rng.randint(min_words, max_words)):
+        if rng.random() < 0.08:
+            tokens.append(rng.choice(ENTITIES)[0])
+        else:
+            tokens.append(rng.choice(WORDS))
+    text = ' '.join(tokens)
+    offset = 0
+    for token in tokens:
+        for name, type_, serials in ENTITIES:
+            if token.startswith(name) and (
+                    len(token) == len(name) or token[len(name)] == ' '):
+                entities.append((offset, offset+len(name), name, type_,
+                                 serials))
+        offset += len(token) + 1
+    return text, entities
+
+
+def generate_document(rng):
+    sections = [generate_section(rng, 5, 20), generate_section(rng, 50, 300)]
+    if rng.random() < 0.3:
+        # full text
+        for i in range(rng.randint(1, 20)):
+            sections.append(generate_section(rng, 50, 500))
+    text, entities, offset = [], [], 0
+    for section_text, section_entities in sections:
+        for start, end, name, type_, serials in section_entities:
+            entities.append((start+offset, end+offset, name, type_, serials))
+        text.append(section_text)
+        offset += len(section_text) + 1    # tab
+    return '\t'.join(text), entities
+
+
+def span_line(doc_id, text, start, end, name, type_, serials, char_offsets):
+    if not char_offsets:
+        # byte offsets
+        start = len(text[:start].encode('utf-8'))
+        end = start + len(name.encode('utf-8'))
+    return '\t'.join([
+        doc_id, '1', '1', str(start), str(end-1), name, type_, serials
+    ])
+
+
+def generate_corpus(dir_, options):
+    rng = random.Random(options.seed)
+    os.makedirs(dir_, exist_ok=True)
+    paths = [os.path.join(dir_, fn) for fn in [DOC_FN]+TAG_FNS+[CHAR_TAG_FN]]
+    files = [open(path, 'w', encoding='utf-8') for path in paths]
+    doc_f, tag_f, tag2_f, char_tag_f = files
+    doc_num = 10000000
+    for i in range(options.docs):
+        doc_num += rng.randint(1, 3)
+        doc_id = str(doc_num)
+        text, entities = generate_document(rng)
+        print('\t'.join([
+            doc_id, f'PMID:{doc_id}', 'AUTHORS', 'FORUM', '2020',
+            stringdb_escape_text(text)
+        ]), file=doc_f)
+        for entity in entities:
+            print(span_line(doc_id, text, *entity, False), file=tag_f)
+            print(span_line(doc_id, text, *entity, True), file=char_tag_f)
+            # second tagger: agrees mostly, sometimes misses or shifts
+            r = rng.random()
+            if r < 0.1:
+                continue
+            elif r < 0.15:
+                start, end, name, type_, serials = entity
+                entity = (start, end-1, name[:-1], type_, serials)
+            print(span_line(doc_id, text, *entity, False), file=tag2_f)
+    for f in files:
+        f.close()
+    print(f'generated {options.docs} documents in {dir_}', file=sys.stderr)
+
+
+def open_input(path, char_offsets=False):
+    if char_offsets:
+        return open(path, encoding='utf-8')
+    else:
+        return open(path, encoding='ascii', errors='surrogateescape')
+
+
+def read_documents(dir_, char_offsets=False):
+    with open_input(os.path.join(dir_, DOC_FN), char_offsets) as f:
+        return list(DocReader(f))
+
+
+def read_document_spans(dir_, tag_fn, source=None):
+    with open_input(os.path.join(dir_, DOC_FN)) as doc_f:
+        with open_input(os.path.join(dir_, tag_fn)) as tag_f:
+            span_reader = SpanReader(tag_f, source=source)
+            return [
+                (doc, span_reader.document_spans(doc.id))
+                for doc in DocReader(doc_f)
+            ]
+
+
+def bench_doc_reader(dir_):
+    path = os.path.join(dir_, DOC_FN)
+    docs = 0
+    start = time.perf_counter()
+    with open_input(path) as f:
+        for doc in DocReader(f):
+            docs += 1
+    return time.perf_counter()-start, docs, 0, os.path.getsize(path)
+
+
+def bench_span_reader(dir_):
+    path = os.path.join(dir_, TAG_FNS[0])
+    docs, spans = 0, 0
+    start = time.perf_counter()
+    with open_input(os.path.join(dir_, DOC_FN)) as doc_f:
+        with open_input(path) as tag_f:
+            span_reader = SpanReader(tag_f)
+            doc_reader = DocReader(doc_f)
+            for doc_id in doc_reader.document_ids():
+                spans += len(span_reader.document_spans(doc_id))
+                docs += 1
+    return time.perf_counter()-start, docs, spans, os.path.getsize(path)
+
+
+def bench_unescape(dir_):
+    with open_input(os.path.join(dir_, DOC_FN)) as f:
+        texts = [line.rstrip('\n').split('\t')[5] for line in f]
+    start = time.perf_counter()
+    for text in texts:
+        stringdb_unescape_text(text)
+    size = sum(len(t) for t in texts)
+    return time.perf_counter()-start, len(texts), 0, size
+
+
+def bench_compare(dir_):
+    import comparespans
+    options = comparespans.argparser().parse_args(['docs', 'tags'])
+    docs1 = read_document_spans(dir_, TAG_FNS[0], 'a')
+    docs2 = read_document_spans(dir_, TAG_FNS[1], 'b')
+    spans = 0
+    start = time.perf_counter()
+    for (doc, spans1), (_, spans2) in zip(docs1, docs2):
+        comparespans.compare_document_spans(
+            doc.id, 'a', 'b', spans1, spans2, options)
+        spans += len(spans1) + len(spans2)
+    return time.perf_counter()-start, len(docs1), spans, 0
+
+
+def nested_spans(doc_id, source, rng):
+    """Return spans nested in each other, as in long chemical names or
+    tables, mostly agreeing between sources."""
+    spans = []
+    for i in range(NESTED_SPANS):
+        start, end = i, 2 * NESTED_SPANS - i
+        if source == 'b' and rng.random() < 0.1:
+            end -= 1    # disagreement on boundary
+        spans.append(StringSpan(doc_id, '1', '1', start, end, 'x',
+                                'Chemical', 'CIDs00000001', source,
+                                no_type_mapping=True))
+    return spans
+
+
+def bench_compare_nested(dir_, one_to_one=False):
+    import comparespans
+    args = ['--overlap', 'docs', 'tags']
+    if one_to_one:
+        args = ['--one-to-one'] + args
+    options = comparespans.argparser().parse_args(args)
+    rng = random.Random(0)
+    docs = [
+        (doc_id, nested_spans(doc_id, 'a', rng),
+         nested_spans(doc_id, 'b', rng))
+        for doc_id in map(str, range(NESTED_DOCS))
+    ]
+    start = time.perf_counter()
+    for doc_id, spans1, spans2 in docs:
+        comparespans.compare_document_spans(
+            doc_id, 'a', 'b', spans1, spans2, options)
+    spans = 2 * NESTED_DOCS * NESTED_SPANS
+    return time.perf_counter()-start, NESTED_DOCS, spans, 0
+
+
+def bench_compare_nested_one_to_one(dir_):
+    return bench_compare_nested(dir_, one_to_one=True)
+
+
+def non_nested(spans):
+    """Return spans that do not overlap a preceding span."""
+    kept = []
+    for span in sorted(spans):
+        if not kept or kept[-1].end < span.start:
+            kept.append(span)
+    return kept
+
+
+def comparison_counts(stats, overlaps_only=False):
+    overlaps = {
+        k: dict(v) for k, v in stats.overlap_by_source_and_text.items()
+    }
+    if overlaps_only:
+        return overlaps
+    return (stats.tp_by_source, stats.fp_by_source, stats.fn_by_source,
+            overlaps)
+
+
+def check_one_to_one_spans(doc_id, spans1, spans2, nested=True):
+    """Raise AssertionError if --one-to-one without --overlap does not
+    give the same counts as the default comparison. TP, FP and FN are
+    only compared if spans are not nested, where each span can match
+    at most once also in the default comparison."""
+    import comparespans
+    default, one_to_one = (
+        comparison_counts(comparespans.compare_document_spans(
+            doc_id, 'a', 'b', spans1, spans2,
+            comparespans.argparser().parse_args(args + ['docs', 'tags'])),
+            overlaps_only=nested)
+        for args in ([], ['--one-to-one'])
+    )
+    if default != one_to_one:
+        raise AssertionError(f'--one-to-one differs in {doc_id}: '
+                             f'{one_to_one} vs. {default}')
+
+
+def check_one_to_one(dir_):
+    """Check --one-to-one against the default comparison on corpus spans
+    with and without nesting and on nested worst case spans."""
+    docs1 = read_document_spans(dir_, TAG_FNS[0], 'a')
+    docs2 = read_document_spans(dir_, TAG_FNS[1], 'b')
+    for (doc, spans1), (_, spans2) in zip(docs1, docs2):
+        check_one_to_one_spans(doc.id, spans1, spans2)
+        check_one_to_one_spans(doc.id, non_nested(spans1),
+                               non_nested(spans2), nested=False)
+    rng = random.Random(0)
+    for doc_id in map(str, range(NESTED_DOCS)):
+        check_one_to_one_spans(doc_id, nested_spans(doc_id, 'a', rng),
+                               nested_spans(doc_id, 'b', rng))
+    print(f'checked --one-to-one on {len(docs1)} documents',
+          file=sys.stderr)
+
+
+def bench_tagger2standoff_offsets(dir_):
+    import tagger2standoff
+    docs = read_documents(dir_)
+    start = time.perf_counter()
+    for doc in docs:
+        tagger2standoff.make_offset_map(doc.text)
+    size = sum(len(d.text) for d in docs)
+    return time.perf_counter()-start, len(docs), 0, size
+
+
+def bench_char_to_byte_offsets(dir_):
+    import char_to_byte_offsets
+    options = Namespace(encoding='utf-8')
+    docs = read_documents(dir_, char_offsets=True)
+    start = time.perf_counter()
+    for doc in docs:
+        char_to_byte_offsets.make_offset_map(doc.text, options)
+    size = sum(len(d.text.encode('utf-8')) for d in docs)
+    return time.perf_counter()-start, len(docs), 0, size
+
+
+BENCHMARKS = {
+    'doc_reader': bench_doc_reader,
+    'span_reader': bench_span_reader,
+    'unescape': bench_unescape,
+    'compare_document_spans': bench_compare,
+    'compare_nested': bench_compare_nested,
+    'compare_nested_one_to_one': bench_compare_nested_one_to_one,
+    'tagger2standoff_offset_map': bench_tagger2standoff_offsets,
+    'char_to_byte_offset_map': bench_char_to_byte_offsets,
+}
+
+
+def run_benchmark(name, dir_, conn):
+    seconds, docs, spans, size = BENCHMARKS[name](dir_)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    conn.send({
+        'seconds': seconds,
+        'docs_per_second': docs / seconds if seconds else 0,
+        'spans_per_second': spans / seconds if seconds else 0,
+        'mb_per_second': size / 2**20 / seconds if seconds else 0,
+        'peak_rss_mb': peak_rss / 2**20,
+    })
+    conn.close()
+
+
+def run_isolated(name, dir_):
+    """Run benchmark in separate process, return its results."""
+    context = multiprocessing.get_context('fork')
+    recv_conn, send_conn = context.Pipe(duplex=False)
+    process = context.Process(target=run_benchmark,
+                              args=(name, dir_, send_conn))
+    process.start()
+    send_conn.close()
+    try:
+        result = recv_conn.recv()
+    except EOFError:
+        raise RuntimeError(f'benchmark {name} failed')
+    process.join()
+    return result
+
+
+def print_result(name, result, baseline=None):
+    line = (f'{name:<28} {result["seconds"]:8.2f}s '
+            f'{result["docs_per_second"]:10.0f} docs/s '
+            f'{result["spans_per_second"]:10.0f} spans/s '
+            f'{result["mb_per_second"]:7.1f} MB/s '
+            f'{result["peak_rss_mb"]:7.1f} MB RSS')
+    if baseline is not None and name in baseline:
+        ratio = baseline[name]['seconds'] / result['seconds']
+        line += f' {ratio:5.2f}x'
+    print(line)
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    if args.regenerate or not os.path.exists(os.path.join(args.dir, DOC_FN)):
+        generate_corpus(args.dir, args)
+    if args.generate_only:
+        return 0
+    if args.check:
+        check_one_to_one(args.dir)
+        return 0
+
+    if args.only is None:
+        names = list(BENCHMARKS)
+    else:
+        names = args.only.split(',')
+        for name in names:
+            if name not in BENCHMARKS:
+                raise ValueError(f'unknown benchmark {name}')
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)['benchmarks']
+
+    results = {}
+    for name in names:
+        results[name] = run_isolated(name, args.dir)
+        print_result(name, results[name], baseline)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'corpus': args.dir,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'benchmarks': results
+        }, f, indent=2)
+    print(f'saved results in {args.output}', file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -6,9 +6,12 @@ Map character to byte offsets in STRING DB all_matches.tsv format.
 
 import sys
 
-from argparse import ArgumentParser
+from argparse import ArgumentParser, Namespace
 
-from common import DocReader, SpanReader
+from common import iter_documents_with_spans, parse_stringdb_span_line
+from common import add_output_arguments
+from common import add_shard_arguments, open_sharded_writer
+from common import profiler, profiling, add_profile_arguments, register_stage
 
 
 def argparser():
@@ -16,6 +19,11 @@ def argparser():
     ap.add_argument('--max-docs', default=None, type=int)
     ap.add_argument('--encoding', default='utf-8', action='store_true',
                     help='input encoding')
+    ap.add_argument('--out', default='-',
+                    help='output file (default stdout)')
+    add_profile_arguments(ap)
+    add_output_arguments(ap)
+    add_shard_arguments(ap)
     ap.add_argument('docs', help='documents in database_documents.tsv format')
     ap.add_argument('tags', help='tagged strings in all_matches.tsv format')
     return ap
@@ -36,28 +44,52 @@ def char_and_byte_offsets_are_identical(text, options):
     return len(text) == len(encoded)    # TODO could this ever fail?
 
 
+@register_stage('char-to-byte')
+def char_to_byte_stage(encoding, options):
+    """Pipeline stage mapping span character offsets to byte offsets."""
+    map_options = Namespace(encoding=encoding or 'utf-8')
+    def map_spans(doc, spans):
+        if not char_and_byte_offsets_are_identical(doc.text, map_options):
+            offset_map = make_offset_map(doc.text, map_options)
+            for span in spans:
+                span.start = offset_map[span.start]
+                span.end = offset_map[span.end+1] - 1
+        return doc, spans
+    return map_spans
+
+
 def char_to_byte_offsets(doc_fn, tag_fn, options):
     doc_count = 0
     with open(doc_fn, encoding=options.encoding) as doc_f:
-        doc_reader = DocReader(doc_f)
-        with open(tag_fn, encoding=options.encoding) as tag_f:
-            span_reader = SpanReader(tag_f)
-            for doc in doc_reader:
+        with open(tag_fn, encoding=options.encoding) as tag_f, \
+             open_sharded_writer(options.out, options,
+                                 encoding=options.encoding) as writers:
+            documents = iter_documents_with_spans(doc_f, [tag_f], parse=False)
+            for doc, (lines,) in documents:
                 if options.max_docs and doc_count >= options.max_docs:
                     break
+                out = writers.writer(doc.id)
                 if char_and_byte_offsets_are_identical(doc.text, options):
                     # fast common case for trivial mapping
-                    for span in span_reader.document_lines(doc.id):
-                        print(span, end='')
+                    with profiler.stage('write'):
+                        for span in lines:
+                            out.write(span)
                 else:
                     # non-trivial mapping
-                    offset_map = make_offset_map(doc.text, options)
-                    for span in span_reader.document_spans(doc.id):
-                        span.start = offset_map[span.start]
-                        # offsets are end inclusive, so take the last byte
-                        # before the next character
-                        span.end = offset_map[span.end+1] - 1
-                        print(span)
+                    with profiler.stage('parse'):
+                        spans = [
+                            parse_stringdb_span_line(line) for line in lines
+                        ]
+                    with profiler.stage('map'):
+                        offset_map = make_offset_map(doc.text, options)
+                        for span in spans:
+                            span.start = offset_map[span.start]
+                            # offsets are end inclusive, so take the last
+                            # byte before the next character
+                            span.end = offset_map[span.end+1] - 1
+                    with profiler.stage('write'):
+                        for span in spans:
+                            out.write_span(span)
                 doc_count += 1
                 if doc_count % 10000 == 0:
                     print(f'processed {doc_count} documents', file=sys.stderr)
@@ -65,7 +97,8 @@ def char_to_byte_offsets(doc_fn, tag_fn, options):
 
 def main(argv):
     args = argparser().parse_args(argv[1:])
-    char_to_byte_offsets(args.docs, args.tags, args)
+    with profiling(args):
+        char_to_byte_offsets(args.docs, args.tags, args)
     return 0
 
 
@@ -4,13 +4,17 @@ import sys
 
 from argparse import ArgumentParser
 
-from common import DocReader, SpanReader, open_file, safe_str
+from common import SpanReader, iter_documents_with_spans, open_file, safe_str
+from common import profiler, profiling, add_profile_arguments
+from common import add_input_arguments
 
 
 def argparser():
     ap = ArgumentParser()
     ap.add_argument('--char-offsets', default=False, action='store_true',
                     help='offsets are character- instead of byte-based')
+    add_input_arguments(ap)
+    add_profile_arguments(ap)
     ap.add_argument('docs', help='documents in database_documents.tsv format')
     ap.add_argument('tags', help='tagged strings in all_matches.tsv format')
     return ap
@@ -19,24 +23,27 @@ def argparser():
 def check_spans(doc_fn, tag_fn, options):
     doc_count, span_count, mismatches = 0, 0, 0
     with open_file(doc_fn, 'r', options) as doc_f:
-        doc_reader = DocReader(doc_f)
         with open_file(tag_fn, 'r', options) as tag_f:
             span_reader = SpanReader(tag_f)
-            for doc in doc_reader:
-                for span in span_reader.document_spans(doc.id):
-                    doc_span_text = doc.text[span.start:span.end+1]
-                    if doc_span_text != span.text:
-                        dt, st = safe_str(doc_span_text), safe_str(span.text)
-                        print(f'text mismatch in {doc.id}: "{dt}" '
-                              f'vs "{st}: {span}"')
-                        mismatches += 1
-                    span_count += 1
+            documents = iter_documents_with_spans(doc_f, [span_reader])
+            for doc, (spans,) in documents:
+                with profiler.stage('validate'):
+                    for span in spans:
+                        doc_span_text = doc.text[span.start:span.end+1]
+                        if doc_span_text != span.text:
+                            dt = safe_str(doc_span_text)
+                            st = safe_str(span.text)
+                            print(f'text mismatch in {doc.id}: "{dt}" '
+                                  f'vs "{st}: {span}"')
+                            mismatches += 1
+                        span_count += 1
                 doc_count += 1
                 if doc_count % 10000 == 0:
                     print(f'processed {doc_count} documents '
                           f'({span_count} spans)', file=sys.stderr)
-            span_count, errors = span_reader.iter.index-1, span_reader.errors
-            if span_reader.current_doc_id() is not None:
+            errors = span_reader.errors
+            span_count += errors + span_reader.skipped_lines
+            if span_reader.skipped_lines:
                 print(f'ERROR: extra lines in {tag_fn}')
             if mismatches or errors:
                 print(f'Checked {span_count} spans, found {errors} errors '
@@ -47,7 +54,8 @@ def check_spans(doc_fn, tag_fn, options):
 
 def main(argv):
     args = argparser().parse_args(argv[1:])
-    check_spans(args.docs, args.tags, args)
+    with profiling(args):
+        check_spans(args.docs, args.tags, args)
     return 0
 
 
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+"""
+Count co-mentions of entities in STRING DB all_matches.tsv format.
+
+Entities are the (normalized) serials of spans. For each pair of
+entities, counts the documents, paragraphs and sentences that mention
+both. Counts are accumulated in memory and spilled to disk as sorted
+runs when they grow large, and the runs are merged at the end. Input
+files are processed as parallel shards; each must group the spans of
+a document together, and no document may be split across shards.
+Output lines are ENTITY1 ENTITY2 DOCS PARAGRAPHS SENTENCES, with
+ENTITY1 < ENTITY2, sorted by entity.
+"""
+
+import sys
+import os
+import shutil
+import tempfile
+
+from itertools import combinations
+from multiprocessing import Pool
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+from common import SpanReader, encoding_args, open_file
+from common import write_run, merge_runs
+from common import profiler, profiling, add_profile_arguments
+from common import add_input_arguments
+
+
+# Levels of co-mention, in output column order
+LEVELS = ('document', 'paragraph', 'sentence')
+
+
+def argparser():
+    ap = ArgumentParser(description=__doc__,
+                        formatter_class=RawDescriptionHelpFormatter)
+    ap.add_argument('--char-offsets', default=False, action='store_true',
+                    help='offsets are character- instead of byte-based')
+    ap.add_argument('--types', default=None,
+                    help='comma-separated list of entity types to include')
+    ap.add_argument('--min-count', default=1, type=int,
+                    help='minimum document count of pairs to output')
+    ap.add_argument('--sets-output', default=None, metavar='FILE',
+                    help='write entity sets of documents, paragraphs and '
+                    'sentences to FILE')
+    ap.add_argument('--max-pairs', default=5000000, type=int,
+                    help='number of pairs to count in memory in total, '
+                    'split evenly across workers')
+    ap.add_argument('--jobs', default=os.cpu_count(), type=int,
+                    help='number of parallel workers')
+    ap.add_argument('--tmpdir', default=None,
+                    help='directory for temporary files')
+    add_input_arguments(ap)
+    add_profile_arguments(ap)
+    ap.add_argument('tags', nargs='+', help='tags in all_matches.tsv format')
+    ap.add_argument('out', help='output file')
+    return ap
+
+
+def entity_sets(spans, types=None):
+    """Return entity sets of document, its paragraphs and its sentences,
+    the latter two as dicts keyed by paragraph and (paragraph, sentence)."""
+    document, paragraphs, sentences = set(), {}, {}
+    for span in spans:
+        if types is not None and span.type.lower() not in types:
+            continue
+        par_entities = paragraphs.setdefault(span.par_num, set())
+        sent_entities = sentences.setdefault(
+            (span.par_num, span.sent_num), set())
+        for serial in span.serials:
+            document.add(serial)
+            par_entities.add(serial)
+            sent_entities.add(serial)
+    return document, paragraphs, sentences
+
+
+def write_entity_sets(doc_id, document, paragraphs, sentences, out):
+    print(doc_id, 'document', '-', ','.join(sorted(document)), sep='\t',
+          file=out)
+    for par_num, entities in paragraphs.items():
+        print(doc_id, 'paragraph', par_num, ','.join(sorted(entities)),
+              sep='\t', file=out)
+    for (par_num, sent_num), entities in sentences.items():
+        print(doc_id, 'sentence', f'{par_num}.{sent_num}',
+              ','.join(sorted(entities)), sep='\t', file=out)
+
+
+def count_pairs(entities, level, counts):
+    for pair in combinations(sorted(entities), 2):
+        pair_counts = counts.get(pair)
+        if pair_counts is None:
+            pair_counts = counts[pair] = [0, 0, 0]
+        pair_counts[level] += 1
+
+
+def count_lines(counts):
+    for (entity1, entity2), pair_counts in sorted(counts.items()):
+        yield '\t'.join([entity1, entity2, *map(str, pair_counts)]) + '\n'
+
+
+def count_shard(tag_fn, run_dir, max_pairs, options):
+    """Count co-mentions in tag_fn into runs of at most max_pairs pairs,
+    return run and entity set file paths (worker function)."""
+    types = None
+    if options.types is not None:
+        types = set(t.lower() for t in options.types.split(','))
+    runs, counts, sets_fn = [], {}, None
+    with open_file(tag_fn, 'r', options) as tag_f:
+        if options.sets_output is not None:
+            sets_f = tempfile.NamedTemporaryFile(
+                'w', dir=run_dir, delete=False, **encoding_args(options))
+            sets_fn = sets_f.name
+        for doc_id, spans in SpanReader(tag_f).documents():
+            document, paragraphs, sentences = entity_sets(spans, types)
+            if sets_fn is not None:
+                write_entity_sets(doc_id, document, paragraphs, sentences,
+                                  sets_f)
+            count_pairs(document, 0, counts)
+            for entities in paragraphs.values():
+                count_pairs(entities, 1, counts)
+            for entities in sentences.values():
+                count_pairs(entities, 2, counts)
+            if len(counts) >= max_pairs:
+                runs.append(write_run(count_lines(counts), options, run_dir))
+                counts = {}
+        if sets_fn is not None:
+            sets_f.close()
+    if counts:
+        runs.append(write_run(count_lines(counts), options, run_dir))
+    return runs, sets_fn
+
+
+def pair_key(line):
+    return line.split('\t', 2)[:2]
+
+
+def sum_pair_counts(lines):
+    """Generate lines of merged runs, summing counts of identical pairs."""
+    pair, pair_counts = None, None
+    for line in lines:
+        fields = line.rstrip('\n').split('\t')
+        if fields[:2] != pair:
+            if pair is not None:
+                yield '\t'.join([*pair, *map(str, pair_counts)]) + '\n'
+            pair, pair_counts = fields[:2], [0, 0, 0]
+        for i, count in enumerate(fields[2:]):
+            pair_counts[i] += int(count)
+    if pair is not None:
+        yield '\t'.join([*pair, *map(str, pair_counts)]) + '\n'
+
+
+def merge_all_runs(runs, out_fn, run_dir, options):
+    lines = merge_runs(runs, pair_key, options, run_dir, sum_pair_counts)
+    with open_file(out_fn, 'w', options) as out_f:
+        for line in lines:
+            if int(line.split('\t', 3)[2]) >= options.min_count:
+                out_f.write(line)
+
+
+def concatenate(fns, out_fn):
+    with open(out_fn, 'wb') as out_f:
+        for fn in fns:
+            with open(fn, 'rb') as f:
+                shutil.copyfileobj(f, out_f)
+            os.remove(fn)
+
+
+def count_comentions(tag_fns, out_fn, options):
+    run_dir = tempfile.mkdtemp(prefix='comentions-', dir=options.tmpdir)
+    try:
+        workers = max(1, min(options.jobs, len(tag_fns)))
+        max_pairs = max(1, options.max_pairs // workers)
+        with profiler.stage('count'), Pool(workers) as pool:
+            results = pool.starmap(
+                count_shard,
+                [(tag_fn, run_dir, max_pairs, options) for tag_fn in tag_fns])
+        runs = [run for shard_runs, _ in results for run in shard_runs]
+        if options.sets_output is not None:
+            with profiler.stage('write'):
+                concatenate([fn for _, fn in results], options.sets_output)
+        print(f'merging {len(runs)} sorted runs', file=sys.stderr)
+        with profiler.stage('merge'):
+            merge_all_runs(runs, out_fn, run_dir, options)
+    finally:
+        shutil.rmtree(run_dir)
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    with profiling(args):
+        count_comentions(args.tags, args.out, args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -3,11 +3,23 @@
 # Common functionality for working with STRING DB / JensenLab tagger data
 
 import sys
+import os
 import re
-
+import json
+import mmap
+import time
+import heapq
+import queue
+import resource
+import tempfile
+import threading
+
+from zlib import crc32
+from bisect import bisect_right
+from contextlib import contextmanager
 from collections.abc import Iterator
 from itertools import tee
-from collections import namedtuple
+from collections import namedtuple, defaultdict, Counter
 from itertools import zip_longest
 
 
@@ -32,11 +44,20 @@ TYPE_MAP = {
 }
 
 
+# Environment variable enabling profiling in all tools (see Profiler)
+PROFILE_ENV_VAR = 'STRINGDB_TOOLS_PROFILE'
+
+
 # Regex for STRING identifiers that should be filtered out. Katerina:
 # COG/KOG are EggNOG identifiers and irrelevant for normalization.
 FILTER_NORM_RE = re.compile(r'^[KC]OG.*')
 
 
+def filter_norms(serials):
+    """Return serials without those matching FILTER_NORM_RE."""
+    return [s for s in serials if not FILTER_NORM_RE.match(s)]
+
+
 # Regex for STRING identifiers prefixed by a taxnomy ID that should be
 # filtered out. Katerina: everything that has a txid 1 (root of
 # taxonomic tree) and 2759 (Eukaryota) should be filtered out.
@@ -77,8 +98,12 @@ class StringDocument:
 
 
 class StringSpan:
+    __slots__ = ('doc_id', 'par_num', 'sent_num', 'start', 'end', 'text',
+                 'type', 'serials', 'source', 'line_no')
+
     def __init__(self, doc_id, par_num, sent_num, start, end, text, type_,
-                 serial, source=None, line_no=None, no_type_mapping=False):
+                 serial, source=None, line_no=None, no_type_mapping=False,
+                 no_norm_filtering=False):
         self.doc_id = doc_id
         self.par_num = par_num
         self.sent_num = sent_num
@@ -90,10 +115,8 @@ class StringSpan:
         self.source = source
         self.line_no = line_no
 
-        self.serials = [
-            s for s in self.serials
-            if not FILTER_NORM_RE.match(s)
-        ]
+        if not no_norm_filtering:
+            self.serials = filter_norms(self.serials)
 
         if not no_type_mapping:
             orig_type = self.type
@@ -148,6 +171,48 @@ class StringSpan:
         return '\t'.join(fields)
 
 
+class _SpanGroup:
+    """First of spans with identical boundaries and types, with serials
+    and sources of the others (created only for duplicates)."""
+
+    __slots__ = ('span', 'serials', 'sources')
+
+    def __init__(self, span):
+        self.span = span
+        self.serials = self.sources = None
+
+
+def deduplicate_spans(spans, merge_sources=False):
+    """Combine serials (and sources if merge_sources is True) of spans with
+    identical boundaries and types into the first of them.
+
+    Returns the first spans in their original order. Serials and sources
+    are deduplicated, and merged sources are comma-separated in sorted
+    order. Duplicates are not retained.
+    """
+    groups = {}
+    for span in spans:
+        key = (span.start, span.end, span.type)
+        group = groups.get(key)
+        if group is None:
+            groups[key] = _SpanGroup(span)
+            continue
+        if group.serials is None:
+            group.serials = dict.fromkeys(group.span.serials)
+            group.sources = { group.span.source }
+        group.serials.update(dict.fromkeys(span.serials))
+        group.sources.add(span.source)
+    deduped = []
+    for group in groups.values():
+        span = group.span
+        if group.serials is not None:
+            span.serials = list(group.serials)
+            if merge_sources:
+                span.source = ','.join(sorted(group.sources))
+        deduped.append(span)
+    return deduped
+
+
 class LookaheadIterator(Iterator):
     """Lookahead iterator from http://stackoverflow.com/a/1518097."""
 
@@ -168,27 +233,186 @@ class LookaheadIterator(Iterator):
         return self.lookahead is not None
 
 
+class TrackedLineReader(Iterator):
+    """Line iterator over file that tracks byte offsets.
+
+    Allows reading to be resumed from lookahead_offset() when used
+    with LookaheadIterator (DocReader, SpanReader).
+    """
+
+    def __init__(self, fn, options, offset=0):
+        self.name = fn
+        self.file = open(fn, 'rb')
+        self.encoding = encoding_args(options)
+        self.file.seek(offset)
+        self.offset = self.line_start = offset
+
+    def lookahead_offset(self):
+        """Return offset of the last line read, or the end offset if the
+        whole file has been read."""
+        return self.line_start
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __next__(self):
+        line = self.file.readline()
+        self.line_start = self.offset
+        if not line:
+            raise StopIteration
+        self.offset += len(line)
+        return line.decode(**self.encoding)
+
+
+class ReadAheadStream(Iterator):
+    """Line iterator over file read ahead by a background thread.
+
+    The thread reads blocks of block_size bytes, decodes them and splits
+    them into lines, and passes batches of lines to the iterator through
+    a queue of at most depth batches, overlapping I/O and decoding with
+    processing. Tracks the queue depth seen by the consumer, the number
+    and duration of stalls waiting for the reader thread and the time
+    the thread waits for the consumer (see stats()).
+    """
+
+    _END = object()
+
+    def __init__(self, fn, options, block_size=2**22, depth=8):
+        self.name = fn
+        self.file = open(fn, 'rb')
+        self.encoding = encoding_args(options)
+        self.block_size = block_size
+        self.depth = depth
+        self.queue = queue.Queue(maxsize=depth)
+        self.batch = iter(())
+        self.finished = self.closed = False
+        self.batches = self.depth_sum = self.max_depth = self.stalls = 0
+        self.stall_time = self.producer_wait_time = 0.0
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        start = time.perf_counter()
+        while not self.closed:
+            try:
+                self.queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self.producer_wait_time += time.perf_counter() - start
+
+    def _read(self):
+        try:
+            remainder = b''
+            while not self.closed:
+                block = self.file.read(self.block_size)
+                if not block:
+                    break
+                block = remainder + block
+                cut = block.rfind(b'\n') + 1
+                remainder = block[cut:]
+                if cut:
+                    lines = block[:cut].decode(**self.encoding).split('\n')
+                    self._put([line + '\n' for line in lines[:-1]])
+            if remainder:
+                self._put([remainder.decode(**self.encoding)])
+            self._put(self._END)
+        except Exception as e:
+            self._put(e)
+
+    def __next__(self):
+        try:
+            return next(self.batch)
+        except StopIteration:
+            pass
+        while True:
+            if self.finished:
+                raise StopIteration
+            depth = self.queue.qsize()
+            self.depth_sum += depth
+            self.max_depth = max(self.max_depth, depth)
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                start = time.perf_counter()
+                item = self.queue.get()
+                self.stalls += 1
+                self.stall_time += time.perf_counter() - start
+            if item is self._END:
+                self.finished = True
+                raise StopIteration
+            elif isinstance(item, Exception):
+                self.finished = True
+                raise item
+            self.batches += 1
+            if item:
+                self.batch = iter(item)
+                return next(self.batch)
+
+    def stats(self):
+        gets = self.batches + self.finished
+        return {
+            'batches': self.batches,
+            'mean_queue_depth': self.depth_sum / gets if gets else 0,
+            'max_queue_depth': self.max_depth,
+            'queue_capacity': self.depth,
+            'stalls': self.stalls,
+            'stall_seconds': self.stall_time,
+            'reader_wait_seconds': self.producer_wait_time,
+        }
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.thread.join()
+        self.file.close()
+        if profiler.enabled:
+            profiler.set_metric(f'read_ahead {self.name}', self.stats())
+            profiler.add_time('read_ahead_stall', self.stall_time)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 class DocReader(Iterator):
     """Reader for database_documents.tsv format."""
-    def __init__(self, stream):
+    def __init__(self, stream, start_line=1):
         self.stream = stream
-        self.iter = LookaheadIterator(stream, start=1)
+        self.iter = LookaheadIterator(stream, start=start_line)
 
     def current_doc_id(self):
         """Return id of document at the current position of the stream."""
         if self.iter.lookahead is None:
             return None
         else:
-            return self.iter.lookahead.split()[0]
+            return self.iter.lookahead.split('\t', 1)[0]
+
+    def document_ids(self):
+        """Return IDs of remaining documents without parsing them."""
+        for line in self.iter:
+            yield line.split('\t', 1)[0]
 
     def __next__(self):
         ln = self.iter.index
-        line = next(self.iter)
+        with profiler.stage('read'):
+            line = next(self.iter)
         try:
-            doc = parse_stringdb_input_line(line)
+            with profiler.stage('parse'):
+                doc = parse_stringdb_input_line(line)
         except:
             raise ValueError(f'error parsing {self.stream.name} line {ln}: '
                              f'{line}')
+        profiler.count(docs=1, bytes_=len(line))
         return doc
 
 
@@ -196,26 +420,58 @@ class SpanReader:
     """Reader for all_matches.tsv format."""
 
     def __init__(self, stream, source=None, raise_on_error=False,
-                 no_type_mapping=False):
+                 no_type_mapping=False, start_line=1, no_norm_filtering=False):
         self.stream = stream
         self.source = source
         self.raise_on_error = raise_on_error
         self.no_type_mapping = no_type_mapping
-        self.iter = LookaheadIterator(stream, start=1)
+        self.no_norm_filtering = no_norm_filtering
+        self.iter = LookaheadIterator(stream, start=start_line)
         self.errors = 0
+        self.skipped_docs = self.skipped_lines = 0
+        self._fields_line = self._fields = None
+
+    def lookahead_fields(self):
+        """Return fields of the line at the current position of the stream.
+
+        Each line is split only once, also when called repeatedly.
+        """
+        line = self.iter.lookahead
+        if line is not self._fields_line:
+            self._fields_line = line
+            if line is None:
+                self._fields = None
+            else:
+                self._fields = line.rstrip('\n').split('\t')
+        return self._fields
 
     def current_doc_id(self):
         """Return id of document at the current position of the stream."""
-        if self.iter.lookahead is None:
-            return None
-        else:
-            return self.iter.lookahead.split()[0]
+        fields = self.lookahead_fields()
+        return fields[0] if fields is not None else None
+
+    def documents(self):
+        """Generate (doc_id, spans) for the documents in the stream."""
+        while self.current_doc_id() is not None:
+            doc_id = self.current_doc_id()
+            yield doc_id, self.document_spans(doc_id)
+
+    def skip_remaining(self):
+        """Advance to the end of the stream, recording the numbers of
+        documents and lines skipped."""
+        while self.current_doc_id() is not None:
+            self.skipped_docs += 1
+            self.skipped_lines += len(self.document_lines(
+                self.current_doc_id()))
 
     def document_lines(self, doc_id):
         """Return lines for document doc_id and advance past them."""
         spans = []
-        while self.current_doc_id() == doc_id:
-            spans.append(next(self.iter))
+        with profiler.stage('read_spans'):
+            while self.current_doc_id() == doc_id:
+                spans.append(next(self.iter))
+        if profiler.enabled:
+            profiler.count(spans=len(spans), bytes_=sum(map(len, spans)))
         return spans
 
     def document_spans(self, doc_id):
@@ -224,26 +480,1001 @@ class SpanReader:
         If doc_id does not match the current position of the stream, returns
         an empty list without advancing in the stream.
         """
+        spans, size = [], 0
+        with profiler.stage('read_and_parse_spans'):
+            while self.current_doc_id() == doc_id:
+                line = self.iter.lookahead
+                size += len(line)
+                self._parse(self.lookahead_fields(), line, self.iter.index,
+                            spans)
+                next(self.iter)
+        profiler.count(spans=len(spans), bytes_=size)
+        return spans
+
+    def parse_lines(self, lines):
+        """Return spans for lines returned by document_lines()."""
         spans = []
-        while self.current_doc_id() == doc_id:
-            try:
-                line = self.iter.lookahead.rstrip('\n')
-                span = parse_stringdb_span_line(
-                    line,
-                    source=self.source,
-                    no_type_mapping=self.no_type_mapping
-                )
-                span.line_no = self.iter.index
-                spans.append(span)
-            except Exception as e:
-                self.errors += 1
-                print(f'error parsing {self.stream.name} line '
-                      f'{self.iter.index}: {e}: {line}', file=sys.stderr)
-                if self.raise_on_error:
-                    raise
-            next(self.iter)
+        with profiler.stage('parse_spans'):
+            for line in lines:
+                fields = line.rstrip('\n').split('\t')
+                self._parse(fields, line, None, spans)
         return spans
 
+    def _parse(self, fields, line, line_no, spans):
+        try:
+            span = stringdb_span_from_fields(
+                fields,
+                source=self.source,
+                no_type_mapping=self.no_type_mapping,
+                no_norm_filtering=self.no_norm_filtering
+            )
+            span.line_no = line_no
+            spans.append(span)
+        except Exception as e:
+            self.errors += 1
+            line = line.rstrip('\n')
+            where = f' line {line_no}' if line_no is not None else ''
+            print(f'error parsing {self.stream.name}{where}: {e}: {line}',
+                  file=sys.stderr)
+            if self.raise_on_error:
+                raise
+
+
+def iter_documents_with_spans(doc_stream, tag_streams, sources=None,
+                              parse=True, **kwargs):
+    """Iterate over documents together with their spans in tag streams.
+
+    Yields (doc, [spans per tag stream]), where spans are StringSpans or,
+    if parse is False, lines. The tag streams must list documents in the
+    same order as doc_stream; documents without spans get empty lists.
+    Tagged documents not matched to a document are reported at the end.
+    Streams may also be given as DocReader and SpanReader instances;
+    other keyword arguments are passed to SpanReader.
+    """
+    if isinstance(doc_stream, DocReader):
+        doc_reader = doc_stream
+    else:
+        doc_reader = DocReader(doc_stream)
+    if sources is None:
+        sources = [None] * len(tag_streams)
+    span_readers = [
+        s if isinstance(s, SpanReader) else SpanReader(s, source, **kwargs)
+        for s, source in zip(tag_streams, sources)
+    ]
+    for doc in doc_reader:
+        if parse:
+            spans = [r.document_spans(doc.id) for r in span_readers]
+        else:
+            spans = [r.document_lines(doc.id) for r in span_readers]
+        yield doc, spans
+    for span_reader in span_readers:
+        span_reader.skip_remaining()
+        if span_reader.skipped_lines:
+            print(f'warning: {span_reader.skipped_docs} documents '
+                  f'({span_reader.skipped_lines} lines) in '
+                  f'{span_reader.stream.name} not matched to documents in '
+                  f'{doc_reader.stream.name}', file=sys.stderr)
+
+
+class MergeJoinReader(Iterator):
+    """k-way merge-join of all_matches.tsv streams by document ID.
+
+    Yields (doc_id, [spans per reader]) for the union of document IDs
+    in the given SpanReaders in doc_id_key() order, with lines instead
+    of spans if parse is False. Each stream must be grouped by document
+    and ordered by doc_id_key(); raises ValueError on out-of-order input
+    (see SortedLineStream).
+    """
+
+    def __init__(self, span_readers, parse=True):
+        self.readers = span_readers
+        self.parse = parse
+        self.heap = []
+        self.last_key = [None] * len(span_readers)
+        for i in range(len(span_readers)):
+            self._push(i)
+
+    def _push(self, i):
+        doc_id = self.readers[i].current_doc_id()
+        if doc_id is None:
+            return
+        key = doc_id_key(doc_id)
+        if self.last_key[i] is not None and key <= self.last_key[i]:
+            reader = self.readers[i]
+            raise ValueError(f'{reader.stream.name} line {reader.iter.index}'
+                             f' out of order: {doc_id} (sort by document'
+                             f' ID first)')
+        self.last_key[i] = key
+        heapq.heappush(self.heap, (key, i, doc_id))
+
+    def current_doc_id(self):
+        """Return smallest document ID at the current position of the
+        streams."""
+        return self.heap[0][2] if self.heap else None
+
+    def __next__(self):
+        if not self.heap:
+            raise StopIteration
+        key, _, doc_id = self.heap[0]
+        spans = [[] for _ in self.readers]
+        while self.heap and self.heap[0][0] == key:
+            _, i, _ = heapq.heappop(self.heap)
+            if self.parse:
+                spans[i] = self.readers[i].document_spans(doc_id)
+            else:
+                spans[i] = self.readers[i].document_lines(doc_id)
+            self._push(i)
+        return doc_id, spans
+
+
+def merge_join_documents(doc_reader, span_readers, parse=True):
+    """Join documents with spans from span_readers by document ID.
+
+    Yields (doc, [spans per reader]), with lines instead of spans if
+    parse is False. Both the documents and the spans must be ordered by
+    doc_id_key(); span documents not found in the documents are skipped
+    and reported at the end.
+    """
+    merged = MergeJoinReader(span_readers, parse)
+    last_key, extra_docs = None, 0
+    for doc in doc_reader:
+        key = doc_id_key(doc.id)
+        if last_key is not None and key <= last_key:
+            raise ValueError(f'{doc_reader.stream.name} out of order: '
+                             f'{doc.id} (sort by document ID first)')
+        last_key = key
+        while (merged.current_doc_id() is not None and
+               doc_id_key(merged.current_doc_id()) < key):
+            next(merged)
+            extra_docs += 1
+        if merged.current_doc_id() == doc.id:
+            doc_id, spans = next(merged)
+        else:
+            spans = [[] for _ in span_readers]
+        yield doc, spans
+    for doc_id, spans in merged:
+        extra_docs += 1
+    if extra_docs:
+        print(f'warning: {extra_docs} tagged documents not found in '
+              f'{doc_reader.stream.name}', file=sys.stderr)
+
+
+# Maximum number of sorted runs to merge at once
+MAX_MERGE = 256
+
+
+def write_run(lines, options, tmpdir=None):
+    """Write lines to new temporary file in tmpdir, return its path."""
+    run = tempfile.NamedTemporaryFile('w', dir=tmpdir, delete=False,
+                                      **encoding_args(options))
+    try:
+        with run:
+            run.writelines(lines)
+    except BaseException:
+        os.remove(run.name)
+        raise
+    return run.name
+
+
+def _merge_run_files(runs, key, options, combine=None):
+    files = []
+    try:
+        for run in runs:
+            files.append(open(run, **encoding_args(options)))
+        # heapq.merge() is stable, runs are in input order
+        lines = heapq.merge(*files, key=key)
+        if combine is not None:
+            lines = combine(lines)
+        yield from lines
+    finally:
+        for f in files:
+            f.close()
+
+
+def merge_runs(runs, key, options, tmpdir=None, combine=None,
+               max_merge=MAX_MERGE):
+    """Generate lines of sorted run files merged by key.
+
+    Merges at most max_merge runs at once, first merging groups of runs
+    into intermediate runs in tmpdir if there are more. If combine is
+    given, it is applied to the merged lines of each pass (e.g. to sum
+    counts of identical keys). Run files are removed once merged.
+    """
+    live = set(runs)
+    try:
+        while len(runs) > max_merge:
+            merged = []
+            for i in range(0, len(runs), max_merge):
+                group = runs[i:i+max_merge]
+                lines = _merge_run_files(group, key, options, combine)
+                merged.append(write_run(lines, options, tmpdir))
+                live.add(merged[-1])
+                for run in group:
+                    os.remove(run)
+                    live.discard(run)
+            runs = merged
+        yield from _merge_run_files(runs, key, options, combine)
+    finally:
+        for run in live:
+            if os.path.exists(run):
+                os.remove(run)
+
+
+class SortedLineStream(Iterator):
+    """Lines of stream in stable order by key, sorted externally.
+
+    Sorts runs of at most buffer_size characters in memory, writes
+    them to temporary files in tmpdir and merges the runs (see
+    merge_runs()). Several streams are typically merged at the same
+    time, so max_merge defaults to a fraction of MAX_MERGE to bound
+    the total number of open files.
+    """
+
+    def __init__(self, stream, key, options, buffer_size=2**28, tmpdir=None,
+                 max_merge=MAX_MERGE//4):
+        self.name = stream.name
+        self.max_merge = max_merge
+        self.key = key
+        self.options = options
+        self.buffer_size = buffer_size
+        self.tmpdir = tmpdir
+        self.runs = []
+        self.iter = self._sorted_lines(stream)
+
+    def _write_run(self, lines):
+        lines.sort(key=self.key)
+        self.runs.append(write_run(lines, self.options, self.tmpdir))
+
+    def _sorted_lines(self, stream):
+        try:
+            buffer, size = [], 0
+            for line in stream:
+                buffer.append(line)
+                size += len(line)
+                if size >= self.buffer_size:
+                    self._write_run(buffer)
+                    buffer, size = [], 0
+            if not self.runs:
+                buffer.sort(key=self.key)
+                yield from buffer
+                return
+            if buffer:
+                self._write_run(buffer)
+            del buffer
+            runs, self.runs = self.runs, []
+            yield from merge_runs(runs, self.key, self.options, self.tmpdir,
+                                  max_merge=self.max_merge)
+        finally:
+            self._remove_runs()
+
+    def _remove_runs(self):
+        for run in self.runs:
+            if os.path.exists(run):
+                os.remove(run)
+        self.runs = []
+
+    def close(self):
+        self.iter.close()
+        self._remove_runs()
+
+    def __next__(self):
+        return next(self.iter)
+
+
+class SpaceSavingCounter:
+    """Bounded-memory approximate counter (Space-Saving algorithm).
+
+    Keeps at most capacity keys. Counts are never underestimated and
+    overestimate the true count by at most error(key). Any key with a
+    true count above total()/capacity is guaranteed to be kept. See
+    Metwally et al. (2005) and, for merging, Agarwal et al. (2012).
+    """
+
+    def __init__(self, capacity=100000):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.heap = []    # (count, key), may contain stale entries
+        self.total_count = 0
+
+    def add(self, key, count=1):
+        self.total_count += count
+        if key in self.counts:
+            self.counts[key] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[key] = count
+            self.errors[key] = 0
+        else:
+            # replace key with minimum count
+            min_key, min_count = self._pop_min()
+            del self.counts[min_key]
+            del self.errors[min_key]
+            self.counts[key] = min_count + count
+            self.errors[key] = min_count
+        self._push(key)
+
+    def update(self, other):
+        """Add counts from mapping, merging if other is a
+        SpaceSavingCounter."""
+        if not isinstance(other, SpaceSavingCounter):
+            for key, count in other.items():
+                self.add(key, count)
+            return
+        # keys missing from a full summary may have up to its min count
+        min1, min2 = self.min_count(), other.min_count()
+        counts, errors = {}, {}
+        for key in self.counts.keys() | other.counts.keys():
+            counts[key] = (self.counts.get(key, min1) +
+                           other.counts.get(key, min2))
+            errors[key] = (self.errors.get(key, min1) +
+                           other.errors.get(key, min2))
+        if len(counts) > self.capacity:
+            keep = heapq.nlargest(self.capacity, counts, key=counts.get)
+            counts = { k: counts[k] for k in keep }
+            errors = { k: errors[k] for k in keep }
+        self.counts, self.errors = counts, errors
+        self.total_count += other.total_count
+        self._rebuild_heap()
+
+    def min_count(self):
+        """Return upper bound for the count of keys not kept."""
+        if len(self.counts) < self.capacity:
+            return 0
+        return self._peek_min()[1]
+
+    def error(self, key):
+        return self.errors.get(key, self.min_count())
+
+    def total(self):
+        return self.total_count
+
+    def most_common(self, number=None):
+        if number is None:
+            return sorted(self.counts.items(), key=lambda i: -i[1])
+        return heapq.nlargest(number, self.counts.items(), key=lambda i: i[1])
+
+    def guaranteed(self, number):
+        """Return whether most_common(number) are guaranteed to be the
+        number most common keys."""
+        top = self.most_common(number+1)
+        other_max = self.min_count()
+        if len(top) > number:
+            other_max = max(other_max, top.pop()[1])
+        return all(c - self.errors[k] >= other_max for k, c in top)
+
+    def _push(self, key):
+        heapq.heappush(self.heap, (self.counts[key], key))
+        if len(self.heap) > 4 * self.capacity:
+            self._rebuild_heap()
+
+    def _rebuild_heap(self):
+        self.heap = [(c, k) for k, c in self.counts.items()]
+        heapq.heapify(self.heap)
+
+    def _peek_min(self):
+        while self.counts.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)    # stale
+        count, key = self.heap[0]
+        return key, count
+
+    def _pop_min(self):
+        key, count = self._peek_min()
+        heapq.heappop(self.heap)
+        return key, count
+
+    def keys(self):
+        return self.counts.keys()
+
+    def items(self):
+        return self.counts.items()
+
+    def __getitem__(self, key):
+        return self.counts.get(key, 0)
+
+    def __contains__(self, key):
+        return key in self.counts
+
+    def __len__(self):
+        return len(self.counts)
+
+
+class SegmentOffsetMap:
+    """Mapping from offsets in a text to offsets in a text formed by
+    joining (start, end) segments of it with a separator of sep_len.
+
+    Offsets are looked up by bisection over the segment starts, so
+    memory use is proportional to the number of segments rather than
+    the length of the text.
+    """
+
+    __slots__ = ('starts', 'ends', 'shifts')
+
+    def __init__(self, segments, sep_len=1):
+        self.starts, self.ends, self.shifts = [], [], []
+        offset = 0
+        for start, end in segments:
+            self.starts.append(start)
+            self.ends.append(end)
+            self.shifts.append(offset-start)
+            offset += end - start + sep_len
+
+    def segment(self, offset):
+        """Return index of segment containing offset or None if cut."""
+        i = bisect_right(self.starts, offset) - 1
+        if i >= 0 and offset < self.ends[i]:
+            return i
+        else:
+            return None
+
+    def overlaps(self, start, end):
+        """Return True if [start, end) overlaps any segment."""
+        i = bisect_right(self.starts, end-1) - 1
+        return i >= 0 and self.ends[i] > start
+
+    def map_span(self, start, end):
+        """Map span with inclusive end. Return mapped (start, end), None if
+        the span is cut entirely, or raise ValueError if cut partially."""
+        i, j = self.segment(start), self.segment(end)
+        if i is not None and i == j:
+            shift = self.shifts[i]
+            return start+shift, end+shift
+        elif i is None and j is None and not self.overlaps(start, end+1):
+            return None
+        else:
+            raise ValueError(f'span {start}-{end} cut partially')
+
+    def __getitem__(self, offset):
+        i = self.segment(offset)
+        return offset + self.shifts[i] if i is not None else None
+
+    def __len__(self):
+        return len(self.starts)
+
+
+class IntervalIndex:
+    """Static index of items with inclusive (start, end) intervals.
+
+    Items are sorted by start and stored as an implicit balanced binary
+    tree annotated with the maximum end in each subtree, so that the
+    items overlapping an interval are found in O(log n + k) time.
+    """
+
+    def __init__(self, items, key=lambda i: (i.start, i.end)):
+        keyed = sorted(((key(i), n, i) for n, i in enumerate(items)),
+                       key=lambda k: (k[0], k[1]))
+        self.starts = [k[0][0] for k in keyed]
+        self.ends = [k[0][1] for k in keyed]
+        self.items = [k[2] for k in keyed]
+        self.max_ends = [None] * len(keyed)
+        self._annotate(0, len(keyed))
+
+    def _annotate(self, lo, hi):
+        if lo >= hi:
+            return -1
+        mid = (lo + hi) // 2
+        self.max_ends[mid] = max(self.ends[mid],
+                                 self._annotate(lo, mid),
+                                 self._annotate(mid+1, hi))
+        return self.max_ends[mid]
+
+    def overlapping(self, start, end):
+        """Return items overlapping [start, end] ordered by start."""
+        found, stack = [], [(0, len(self.items))]
+        while stack:
+            lo, hi = stack.pop()
+            if lo >= hi:
+                continue
+            mid = (lo + hi) // 2
+            if self.max_ends[mid] < start:
+                continue    # everything in subtree ends before start
+            stack.append((lo, mid))
+            if self.starts[mid] <= end:
+                if self.ends[mid] >= start:
+                    found.append(mid)
+                stack.append((mid+1, hi))
+        return [self.items[i] for i in sorted(found)]
+
+    def __len__(self):
+        return len(self.items)
+
+
+class AliasIndex:
+    """Memory-mapped lookup of values by key in an index file.
+
+    The file has KEY<TAB>VALUE lines sorted by the UTF-8 bytes of KEY
+    (see write_alias_index()). Opening is constant time and lookups
+    take O(log n) line reads by binary search over byte positions.
+    """
+
+    def __init__(self, fn):
+        self.file = open(fn, 'rb')
+        if os.path.getsize(fn) == 0:
+            self.mm = None
+        else:
+            self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def get(self, key, default=None):
+        if self.mm is None:
+            return default
+        mm, key = self.mm, key.encode('utf-8')
+        lo, hi = 0, len(mm)    # lo and hi are line starts
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = mm.rfind(b'\n', 0, mid) + 1
+            end = mm.find(b'\n', start)
+            if end == -1:
+                end = len(mm)
+            tab = mm.find(b'\t', start, end)
+            line_key = mm[start:tab if tab != -1 else end]
+            if line_key < key:
+                lo = end + 1
+            elif line_key > key:
+                hi = start
+            else:
+                return mm[tab+1:end].decode('utf-8') if tab != -1 else ''
+        return default
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def write_alias_index(fn, items):
+    """Write (key, value) items as index file for AliasIndex."""
+    items = sorted(items, key=lambda kv: kv[0].encode('utf-8'))
+    with atomic_open(fn, 'w', encoding='utf-8') as f:
+        for key, value in items:
+            if '\t' in key or '\n' in key or '\n' in value:
+                raise ValueError(f'cannot index {key}: {value}')
+            f.write(f'{key}\t{value}\n')
+
+
+class _Stage:
+    """Context manager adding elapsed time to Profiler stage."""
+
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        self.profiler.add_time(self.name, time.perf_counter()-self.start)
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class Profiler:
+    """Per-stage timing and throughput instrumentation.
+
+    Disabled by default; enabled by profiling() with --profile (see
+    add_profile_arguments()) or the STRINGDB_TOOLS_PROFILE environment
+    variable. Reports progress to stderr every interval seconds and a
+    JSON summary at the end.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.interval = 60
+        self.times = defaultdict(float)
+        self.calls = Counter()
+        self.counts = Counter()
+        self.metrics = {}
+        self.start_time = self.last_report = time.perf_counter()
+
+    def enable(self, interval=60):
+        self.enabled = True
+        self.interval = interval
+        self.start_time = self.last_report = time.perf_counter()
+
+    def stage(self, name):
+        """Return context manager timing stage name."""
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def add_time(self, name, seconds):
+        self.times[name] += seconds
+        self.calls[name] += 1
+
+    def set_metric(self, name, value):
+        self.metrics[name] = value
+
+    def count(self, docs=0, spans=0, bytes_=0):
+        if not self.enabled:
+            return
+        self.counts['docs'] += docs
+        self.counts['spans'] += spans
+        self.counts['bytes'] += bytes_
+        now = time.perf_counter()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report()
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start_time
+        rate = lambda n: n / elapsed if elapsed else 0
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return {
+            'elapsed': elapsed,
+            'stages': {
+                name: {
+                    'seconds': seconds,
+                    'calls': self.calls[name],
+                    'fraction': seconds / elapsed if elapsed else 0,
+                }
+                for name, seconds in sorted(self.times.items())
+            },
+            'docs': self.counts['docs'],
+            'spans': self.counts['spans'],
+            'bytes': self.counts['bytes'],
+            'docs_per_second': rate(self.counts['docs']),
+            'spans_per_second': rate(self.counts['spans']),
+            'mb_per_second': rate(self.counts['bytes']) / 2**20,
+            'peak_rss_mb': peak_rss / 2**20,
+            'metrics': self.metrics,
+        }
+
+    def report(self):
+        s = self.summary()
+        stages = ' '.join(
+            f'{n}:{v["fraction"]:.0%}' for n, v in s['stages'].items())
+        print(f'profile: {s["elapsed"]:.0f}s {s["docs_per_second"]:.0f} '
+              f'docs/s {s["spans_per_second"]:.0f} spans/s '
+              f'{s["mb_per_second"]:.1f} MB/s {s["peak_rss_mb"]:.0f} MB RSS '
+              f'{stages}', file=sys.stderr, flush=True)
+
+
+profiler = Profiler()
+
+
+def add_profile_arguments(ap):
+    """Add profiling options to ArgumentParser."""
+    ap.add_argument('--profile', default=False, action='store_true',
+                    help=f'report time per stage and throughput (also '
+                    f'enabled by {PROFILE_ENV_VAR}=1)')
+    ap.add_argument('--profile-interval', default=60, type=float,
+                    metavar='SEC', help='seconds between profile reports')
+    ap.add_argument('--profile-output', default=None, metavar='PATH',
+                    help='save final profile summary as JSON to PATH')
+    ap.add_argument('--cprofile', default=None, metavar='PATH',
+                    help='run with cProfile and dump stats to PATH')
+
+
+@contextmanager
+def profiling(options):
+    """Enable profiler for the duration of the context if requested in
+    options (see add_profile_arguments()) or the environment."""
+    enabled = options.profile or os.environ.get(PROFILE_ENV_VAR, '') not in (
+        '', '0')
+    if enabled:
+        profiler.enable(options.profile_interval)
+    if options.cprofile is not None:
+        import cProfile
+        cprofiler = cProfile.Profile()
+        cprofiler.enable()
+    try:
+        yield profiler
+    finally:
+        if options.cprofile is not None:
+            cprofiler.disable()
+            cprofiler.dump_stats(options.cprofile)
+            print(f'saved cProfile stats in {options.cprofile}',
+                  file=sys.stderr)
+        if enabled:
+            summary = json.dumps(profiler.summary(), indent=2)
+            if options.profile_output is None:
+                print(summary, file=sys.stderr)
+            else:
+                with open(options.profile_output, 'w') as out:
+                    print(summary, file=out)
+
+
+class BatchWriter:
+    """Buffered writer encoding output in large blocks.
+
+    Collects strings in a buffer and writes them to the binary stream
+    encoded in blocks of about buffer_size characters, optionally from
+    a background thread.
+    """
+
+    def __init__(self, stream, encoding='utf-8', errors='strict',
+                 buffer_size=2**20, background=False, close_stream=True):
+        self.stream = stream
+        self.encoding = encoding
+        self.errors = errors
+        self.buffer_size = buffer_size
+        self.close_stream = close_stream
+        self.buffer = []
+        self.size = 0
+        self.error = None
+        if background:
+            self.queue = queue.Queue(maxsize=4)
+            self.thread = threading.Thread(target=self._write_blocks,
+                                           daemon=True)
+            self.thread.start()
+        else:
+            self.queue = self.thread = None
+
+    def write(self, string):
+        self.buffer.append(string)
+        self.size += len(string)
+        if self.size >= self.buffer_size:
+            self._write_buffer()
+
+    def write_line(self, string):
+        self.write(string + '\n')
+
+    def write_span(self, span):
+        fields = [
+            span.doc_id, span.par_num, span.sent_num,
+            str(span.start), str(span.end),
+            span.text, span.type, ','.join(span.serials)
+        ]
+        if span.source is not None:
+            fields.append(span.source)
+        self.write('\t'.join(fields) + '\n')
+
+    def write_document(self, doc):
+        self.write(str(doc) + '\n')
+
+    def _write_buffer(self):
+        if not self.buffer:
+            return
+        data = ''.join(self.buffer).encode(self.encoding, self.errors)
+        self.buffer, self.size = [], 0
+        if self.thread is None:
+            self.stream.write(data)
+        else:
+            self._check_error()
+            self.queue.put(data)
+
+    def _write_blocks(self):
+        while True:
+            data = self.queue.get()
+            try:
+                if data is None:
+                    return
+                if self.error is None:
+                    self.stream.write(data)
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _check_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def flush(self):
+        self._write_buffer()
+        if self.thread is not None:
+            self.queue.join()
+            self._check_error()
+        self.stream.flush()
+
+    def tell(self):
+        self.flush()
+        return self.stream.tell()
+
+    def truncate(self, position):
+        self.flush()
+        self.stream.truncate(position)
+        self.stream.seek(position)
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self.thread is not None:
+                self.queue.put(None)
+                self.thread.join()
+            if self.close_stream:
+                self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def add_output_arguments(ap):
+    """Add BatchWriter options to ArgumentParser."""
+    ap.add_argument('--write-buffer', default=1, type=float, metavar='MB',
+                    help='size of blocks to write output in')
+    ap.add_argument('--write-thread', default=False, action='store_true',
+                    help='write output in background thread')
+
+
+def open_writer(fn, options, mode='w', encoding=None, errors='strict'):
+    """Return BatchWriter for fn ('-' for stdout) configured by options
+    (see add_output_arguments(), defaults if absent). Encoding defaults
+    to that of open_file()."""
+    if encoding is None:
+        args = encoding_args(options)
+        encoding = args.get('encoding', 'utf-8')
+        errors = args.get('errors', 'strict')
+    if fn == '-':
+        stream, close_stream = sys.stdout.buffer, False
+    else:
+        stream, close_stream = open(fn, mode + 'b'), True
+    return BatchWriter(
+        stream, encoding, errors,
+        buffer_size=int(getattr(options, 'write_buffer', 1) * 2**20),
+        background=getattr(options, 'write_thread', False),
+        close_stream=close_stream
+    )
+
+
+def add_shard_arguments(ap):
+    """Add ShardedWriter options to ArgumentParser."""
+    ap.add_argument('--output-shards', default=1, type=int, metavar='N',
+                    help='split output into N shards by document ID')
+
+
+def shard_index(doc_id, shards):
+    """Return shard of doc_id (stable across runs and tools)."""
+    return crc32(doc_id.encode('utf-8', 'surrogateescape')) % shards
+
+
+def shard_filename(fn, index, shards):
+    """Return name of shard index of fn, e.g. out-00001-of-00004.tsv."""
+    root, ext = os.path.splitext(fn)
+    return f'{root}-{index:05d}-of-{shards:05d}{ext}'
+
+
+class ShardedWriter:
+    """BatchWriters for output split into shards by document ID.
+
+    Documents are assigned to shards by shard_index(), so shard k of
+    any two outputs sharded into the same number of shards contains
+    the same documents. With a single shard, writes to fn as such.
+    """
+
+    def __init__(self, fn, options, shards=1, **kwargs):
+        if shards < 1:
+            raise ValueError(f'invalid number of shards: {shards}')
+        if shards > 1 and fn == '-':
+            raise ValueError('cannot write shards to stdout')
+        if shards == 1:
+            fns = [fn]
+        else:
+            fns = [shard_filename(fn, i, shards) for i in range(shards)]
+        self.writers = []
+        try:
+            for shard_fn in fns:
+                self.writers.append(open_writer(shard_fn, options, **kwargs))
+        except BaseException:
+            self.close()
+            raise
+
+    def writer(self, doc_id):
+        """Return BatchWriter for shard of doc_id."""
+        if len(self.writers) == 1:
+            return self.writers[0]
+        return self.writers[shard_index(doc_id, len(self.writers))]
+
+    def close(self):
+        error = None
+        for writer in self.writers:
+            try:
+                writer.close()
+            except BaseException as e:
+                error = error or e
+        if error is not None:
+            raise error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_sharded_writer(fn, options, **kwargs):
+    """Return ShardedWriter for fn configured by options (see
+    add_shard_arguments() and open_writer())."""
+    shards = getattr(options, 'output_shards', 1)
+    return ShardedWriter(fn, options, shards, **kwargs)
+
+
+# Pipeline stage factories by name, see register_stage()
+PIPELINE_STAGES = {}
+
+
+def register_stage(name):
+    """Decorator registering a factory for pipeline stage name.
+
+    The factory is called with the stage argument (or None) and options
+    and returns a function taking a (StringDocument, spans) pair and
+    returning the transformed pair, or None to drop the document.
+    """
+    def register(factory):
+        PIPELINE_STAGES[name] = factory
+        return factory
+    return register
+
+
+class Pipeline:
+    """Sequence of stages applied to (StringDocument, spans) pairs.
+
+    Stages are specified as NAME or NAME:ARG, see register_stage().
+    """
+
+    def __init__(self, specs, options):
+        self.names = []
+        self.stages = []
+        for spec in specs:
+            name, _, arg = spec.partition(':')
+            if name not in PIPELINE_STAGES:
+                raise ValueError(f'unknown stage {name}, expected one of '
+                                 f'{", ".join(sorted(PIPELINE_STAGES))}')
+            self.names.append(name)
+            self.stages.append(PIPELINE_STAGES[name](arg or None, options))
+
+    def __call__(self, doc, spans):
+        """Return result of applying stages to doc and spans, or None if
+        the document was dropped."""
+        for name, stage in zip(self.names, self.stages):
+            with profiler.stage(name):
+                result = stage(doc, spans)
+            if result is None:
+                return None
+            doc, spans = result
+        return doc, spans
+
+    def run(self, documents):
+        """Apply stages to (doc, spans) pairs, yield results not dropped."""
+        for doc, spans in documents:
+            result = self(doc, spans)
+            if result is not None:
+                yield result
+
+
+def doc_id_key(doc_id):
+    """Return sort key for document ID, numeric IDs in numeric order."""
+    try:
+        return (0, int(doc_id), doc_id)
+    except ValueError:
+        return (1, 0, doc_id)
+
+
+def line_doc_id_key(line):
+    """Return doc_id_key() for line in database_documents.tsv or
+    all_matches.tsv format."""
+    return doc_id_key(line.split('\t', 1)[0])
+
 
 def stringdb_escape_text(text):
     """Escape text for database_documents.tsv format."""
@@ -276,10 +1507,18 @@ def parse_stringdb_input_line(line):
     return StringDocument(doc_id, other_ids, authors, forum, year, text)
 
 
-def parse_stringdb_span_line(line, source=None, no_type_mapping=False):
+def parse_stringdb_span_line(line, source=None, no_type_mapping=False,
+                             no_norm_filtering=False):
     """Parse line in all_matches.tsv format, return StringSpan."""
     line = line.rstrip('\n')
     fields = line.split('\t')
+    return stringdb_span_from_fields(fields, source, no_type_mapping,
+                                     no_norm_filtering)
+
+
+def stringdb_span_from_fields(fields, source=None, no_type_mapping=False,
+                              no_norm_filtering=False):
+    """Return StringSpan for fields of line in all_matches.tsv format."""
     doc_id, par_num, sent_num, start, end, text, type_, serial = fields[:8]
     if source is True:    # source as separate field
         source = fields[8]
@@ -289,7 +1528,8 @@ def parse_stringdb_span_line(line, source=None, no_type_mapping=False):
     start, end = int(start), int(end)
     return StringSpan(
         doc_id, par_num, sent_num, start, end, text, type_, serial,
-        source=source, no_type_mapping=no_type_mapping
+        source=source, no_type_mapping=no_type_mapping,
+        no_norm_filtering=no_norm_filtering
     )
 
 
@@ -303,12 +1543,55 @@ def stream_documents(fn):
             yield document
 
 
-def open_file(fn, mode, options):
+def encoding_args(options):
+    """Return encoding keyword arguments for open() given options."""
     if options.char_offsets:
-        return open(fn, mode)
+        return {}
     else:
         # https://www.python.org/dev/peps/pep-0383/ (Python 3.1+)
-        return open(fn, mode, encoding='ascii', errors='surrogateescape')
+        return { 'encoding': 'ascii', 'errors': 'surrogateescape' }
+
+
+def add_input_arguments(ap):
+    """Add ReadAheadStream options to ArgumentParser."""
+    ap.add_argument('--read-ahead', default=False, action='store_true',
+                    help='read input in background thread')
+    ap.add_argument('--read-block', default=4, type=float, metavar='MB',
+                    help='size of blocks to read ahead')
+    ap.add_argument('--read-queue', default=8, type=int, metavar='N',
+                    help='maximum number of blocks read ahead')
+
+
+def open_file(fn, mode, options):
+    if mode == 'r' and getattr(options, 'read_ahead', False):
+        block_size = int(options.read_block * 2**20)
+        return ReadAheadStream(fn, options, block_size, options.read_queue)
+    return open(fn, mode, **encoding_args(options))
+
+
+@contextmanager
+def atomic_open(fn, mode='w', **kwargs):
+    """Open temporary file for writing and rename it to fn on close."""
+    tmp_fn = f'{fn}.tmp{os.getpid()}'
+    try:
+        with open(tmp_fn, mode, **kwargs) as f:
+            yield f
+        os.replace(tmp_fn, fn)
+    finally:
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+
+
+def walk_files(path, suffix):
+    """Generate paths of files with suffix in directory tree, ordered
+    by name within each directory."""
+    with os.scandir(path) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    for entry in entries:
+        if entry.is_dir():
+            yield from walk_files(entry.path, suffix)
+        elif entry.name.endswith(suffix):
+            yield entry.path
 
 
 def load_ids(fn, options):
@@ -1,19 +1,40 @@
 #!/usr/bin/env python3
 
 import sys
+import json
+import pickle
 import random
+import shelve
+import hashlib
 
 from itertools import chain
+from functools import partial
+from logging import warning
+from contextlib import ExitStack
 from collections import defaultdict, Counter, OrderedDict
 from argparse import ArgumentParser
 
-from common import DocReader, SpanReader, unique
+from common import DocReader, SpanReader, SortedLineStream, TrackedLineReader
+from common import SpaceSavingCounter, IntervalIndex, atomic_open
+from common import encoding_args, open_file
+from common import profiler, profiling, add_profile_arguments
+from common import add_input_arguments
+from common import open_writer, add_output_arguments, register_stage
+from common import merge_join_documents, iter_documents_with_spans
+from common import deduplicate_spans, line_doc_id_key, unique
+
+
+# Number of most common texts reported per counter
+TOP_TEXTS = 1000
 
 
 def argparser():
     ap = ArgumentParser()
     ap.add_argument('--overlap', default=False, action='store_true',
                     help='apply overlap matching (default: exact)')
+    ap.add_argument('--one-to-one', default=False, action='store_true',
+                    help='match each span to at most one span in the other '
+                    'source')
     ap.add_argument('--char-offsets', default=False, action='store_true',
                     help='offsets are character- instead of byte-based')
     ap.add_argument('--seed', default=None, type=int,
@@ -22,86 +43,131 @@ def argparser():
     ap.add_argument('--sample', default=None, type=float)
     ap.add_argument('--max-docs', default=None, type=int)
     ap.add_argument('--types', default=None)
+    ap.add_argument('--text-counter', choices=['exact', 'space-saving'],
+                    default='exact',
+                    help='counter for per-text statistics (space-saving: '
+                    'bounded memory, approximate)')
+    ap.add_argument('--text-counter-capacity', default=100000, type=int,
+                    help='texts to keep per counter with space-saving')
     ap.add_argument('--output', default='comparison-results.txt')
+    ap.add_argument('--json-output', default=None, metavar='PATH',
+                    help='also save results in JSON format')
+    ap.add_argument('--doc-stats-output', default=None, metavar='PATH',
+                    help='write per-document TP/FP/FN rows in TSV format')
     ap.add_argument('--names', default=None)
     ap.add_argument('--doc-output', default='comparison-docs.tsv')
     ap.add_argument('--tag-output', default='comparison-tags.tsv')
+    ap.add_argument('--merge-join', default=False, action='store_true',
+                    help='join inputs by document ID (inputs must be '
+                    'ordered by ID) instead of assuming identical order')
+    ap.add_argument('--sort-inputs', default=False, action='store_true',
+                    help='sort inputs by document ID before joining '
+                    '(implies --merge-join)')
+    ap.add_argument('--sort-buffer', default=256, type=int, metavar='MB',
+                    help='memory for in-memory runs of --sort-inputs')
+    ap.add_argument('--tmpdir', default=None,
+                    help='directory for temporary files')
+    ap.add_argument('--checkpoint', default=None, metavar='PATH',
+                    help='save checkpoint to PATH every --save-interval '
+                    'documents')
+    ap.add_argument('--resume', default=False, action='store_true',
+                    help='resume from --checkpoint')
+    ap.add_argument('--cache', default=None, metavar='PATH',
+                    help='cache per-document comparison results in PATH '
+                    'and reuse them for unchanged inputs')
+    add_input_arguments(ap)
+    add_profile_arguments(ap)
+    add_output_arguments(ap)
     ap.add_argument('docs', help='documents in database_documents.tsv format')
     ap.add_argument('tags', nargs='+',
                     help='tagged strings in all_matches.tsv format')
     return ap
 
 
-def open_file(fn, mode, options):
-    if options.char_offsets:
-        return open(fn, mode)
-    else:
-        # https://www.python.org/dev/peps/pep-0383/ (Python 3.1+)
-        return open(fn, mode, encoding='ascii', errors='surrogateescape')
-
-
 def safe_str(string):
     # workaround for 'utf-8' codec can't encode [...]: surrogates not allowed
     return string.encode('utf-8', 'replace').decode()
 
 
 class Stats:
-    def __init__(self, sources):
+    def __init__(self, sources, text_counter=Counter):
         for i in range(len(sources)):
             for j in range(i+1, len(sources)):
                 s = (sources[i], sources[j])
                 self.tp_by_source = Counter({ s: 0 })
                 self.fp_by_source = Counter({ s: 0 })
                 self.fn_by_source = Counter({ s: 0 })
-        self.tp_by_source_and_text = defaultdict(lambda: Counter())
-        self.fp_by_source_and_text = defaultdict(lambda: Counter())
-        self.fn_by_source_and_text = defaultdict(lambda: Counter())
-        self.overlap_by_source_and_text = defaultdict(lambda: Counter())
+        self.tp_by_source_and_text = defaultdict(text_counter)
+        self.fp_by_source_and_text = defaultdict(text_counter)
+        self.fn_by_source_and_text = defaultdict(text_counter)
+        self.overlap_by_source_and_text = defaultdict(text_counter)
+        self.tp_by_source_and_type = defaultdict(Counter)
+        self.fp_by_source_and_type = defaultdict(Counter)
+        self.fn_by_source_and_type = defaultdict(Counter)
+        # counts of matched pairs with exact and any-overlap agreement
+        # of serials and sum of Jaccard indices of serial sets
+        self.serials_by_source = defaultdict(Counter)
 
     def add_stats(self, other):
         for s in other.sources():
             self.tp_by_source[s] += other.tp_by_source[s]
             self.fp_by_source[s] += other.fp_by_source[s]
             self.fn_by_source[s] += other.fn_by_source[s]
-            for t in other.tp_by_source_and_text[s].keys():
-                self.tp_by_source_and_text[s][t] += \
-                    other.tp_by_source_and_text[s][t]
-            for t in other.fp_by_source_and_text[s].keys():
-                self.fp_by_source_and_text[s][t] += \
-                    other.fp_by_source_and_text[s][t]
-            for t in other.fn_by_source_and_text[s].keys():
-                self.fn_by_source_and_text[s][t] += \
-                    other.fn_by_source_and_text[s][t]
-            for t in other.overlap_by_source_and_text[s].keys():
-                self.overlap_by_source_and_text[s][t] += \
-                    other.overlap_by_source_and_text[s][t]
+            self.tp_by_source_and_text[s].update(
+                other.tp_by_source_and_text[s])
+            self.fp_by_source_and_text[s].update(
+                other.fp_by_source_and_text[s])
+            self.fn_by_source_and_text[s].update(
+                other.fn_by_source_and_text[s])
+            self.overlap_by_source_and_text[s].update(
+                other.overlap_by_source_and_text[s])
+            self.tp_by_source_and_type[s].update(
+                other.tp_by_source_and_type[s])
+            self.fp_by_source_and_type[s].update(
+                other.fp_by_source_and_type[s])
+            self.fn_by_source_and_type[s].update(
+                other.fn_by_source_and_type[s])
+            self.serials_by_source[s].update(other.serials_by_source[s])
 
     def add_tp(self, gold, pred, span):
         self.tp_by_source_and_text[(gold, pred)][span.text] += 1
+        self.tp_by_source_and_type[(gold, pred)][span.type] += 1
         self.tp_by_source[(gold, pred)] += 1
 
     def add_fp(self, gold, pred, span):
         self.fp_by_source_and_text[(gold, pred)][span.text] += 1
+        self.fp_by_source_and_type[(gold, pred)][span.type] += 1
         self.fp_by_source[(gold, pred)] += 1
 
     def add_fn(self, gold, pred, span):
         self.fn_by_source_and_text[(gold, pred)][span.text] += 1
+        self.fn_by_source_and_type[(gold, pred)][span.type] += 1
         self.fn_by_source[(gold, pred)] += 1
 
+    def add_serial_agreement(self, gold, pred, span1, span2):
+        serials1, serials2 = set(span1.serials), set(span2.serials)
+        common = len(serials1 & serials2)
+        union = len(serials1) + len(serials2) - common
+        counts = self.serials_by_source[(gold, pred)]
+        counts['pairs'] += 1
+        counts['exact'] += serials1 == serials2
+        counts['overlap'] += common > 0
+        counts['jaccard'] += common/union if union else 1.0
+
     def add_overlap(self, gold, pred, span1, span2):
         texts = f'{span1.text}\t{span2.text}'
         self.overlap_by_source_and_text[(gold, pred)][texts] += 1
 
-    def most_common_tp(self, sources, number=1000):
+    def most_common_tp(self, sources, number=TOP_TEXTS):
         return self.tp_by_source_and_text[sources].most_common(number)
 
-    def most_common_fp(self, sources, number=1000):
+    def most_common_fp(self, sources, number=TOP_TEXTS):
         return self.fp_by_source_and_text[sources].most_common(number)
 
-    def most_common_fn(self, sources, number=1000):
+    def most_common_fn(self, sources, number=TOP_TEXTS):
         return self.fn_by_source_and_text[sources].most_common(number)
 
-    def most_common_overlaps(self, sources, number=1000):
+    def most_common_overlaps(self, sources, number=TOP_TEXTS):
         return self.overlap_by_source_and_text[sources].most_common(number)
 
     def sources(self):
@@ -109,6 +175,11 @@ class Stats:
                    list(self.fp_by_source.keys()) +
                    list(self.fn_by_source.keys()))
 
+    def types(self, sources):
+        return sorted(set(chain(self.tp_by_source_and_type[sources],
+                                self.fp_by_source_and_type[sources],
+                                self.fn_by_source_and_type[sources])))
+
     def total(self, sources):
         return (self.true_positive(sources) +
                 self.false_positive(sources) +
@@ -119,27 +190,47 @@ class Stats:
                             self.fp_by_source_and_text[sources].keys(),
                             self.fn_by_source_and_text[sources].keys()))
 
-    def true_positive(self, sources):
-        return self.tp_by_source[sources]
-
-    def false_positive(self, sources):
-        return self.fp_by_source[sources]
-
-    def false_negative(self, sources):
-        return self.fn_by_source[sources]
-
-    def precision(self, sources):
-        tp = self.true_positive(sources)
-        fp = self.false_positive(sources)
+    def serial_agreement(self, sources):
+        """Return number of matched pairs and fractions with exact and
+        any-overlap serial agreement and mean Jaccard index of serials."""
+        counts = self.serials_by_source[sources]
+        pairs = counts['pairs']
+        return {
+            'pairs': pairs,
+            'exact': counts['exact']/pairs if pairs else 0,
+            'overlap': counts['overlap']/pairs if pairs else 0,
+            'jaccard': counts['jaccard']/pairs if pairs else 0,
+        }
+
+    # Counts and scores are for all types if type_ is None
+
+    def true_positive(self, sources, type_=None):
+        if type_ is None:
+            return self.tp_by_source[sources]
+        return self.tp_by_source_and_type[sources][type_]
+
+    def false_positive(self, sources, type_=None):
+        if type_ is None:
+            return self.fp_by_source[sources]
+        return self.fp_by_source_and_type[sources][type_]
+
+    def false_negative(self, sources, type_=None):
+        if type_ is None:
+            return self.fn_by_source[sources]
+        return self.fn_by_source_and_type[sources][type_]
+
+    def precision(self, sources, type_=None):
+        tp = self.true_positive(sources, type_)
+        fp = self.false_positive(sources, type_)
         return tp/(tp+fp) if tp+fp else 0
 
-    def recall(self, sources):
-        tp = self.true_positive(sources)
-        fn = self.false_negative(sources)
+    def recall(self, sources, type_=None):
+        tp = self.true_positive(sources, type_)
+        fn = self.false_negative(sources, type_)
         return tp/(tp+fn) if tp+fn else 0
 
-    def f_score(self, sources):
-        prec, rec = self.precision(sources), self.recall(sources)
+    def f_score(self, sources, type_=None):
+        prec, rec = self.precision(sources, type_), self.recall(sources, type_)
         return 2*prec*rec/(prec+rec) if prec+rec else 0
 
     def trim(self, ratio=10000):
@@ -176,6 +267,14 @@ def validate_spans(doc_id, doc_text, spans):
     return validated
 
 
+@register_stage('validate')
+def validate_stage(arg, options):
+    """Pipeline stage dropping spans not matching document text."""
+    def validate_document_spans(doc, spans):
+        return doc, validate_spans(doc.id, doc.text, spans)
+    return validate_document_spans
+
+
 def filter_spans(spans, options):
     """Filter spans to types specified in options (if any)."""
     if not options.types:
@@ -184,22 +283,10 @@ def filter_spans(spans, options):
         return [s for s in spans if s.type.lower() in options.types]
 
 
-def deduplicate_spans(spans, options):
-    """Combine serials for spans with identical boundaries and types."""
-    make_key = lambda s: (s.start, s.end, s.type)
-    span_map = defaultdict(list)
-    deduped = []
-    for span in spans:
-        key = make_key(span)
-        if key not in span_map:
-            deduped.append(span)
-        else:
-            span_map[key][0].serials.extend(span.serials)
-        span_map[key].append(span)
-    return deduped
-
-
 def compare_document_spans(doc_id, source1, source2, spans1, spans2, options):
+    if options.one_to_one:
+        return compare_document_spans_one_to_one(
+            doc_id, source1, source2, spans1, spans2, options)
     # Avoiding O(n^2) comparison: create list of (offset, start/end,
     # span), sort with end<start, and then iterate over the list while
     # maintaining a list of currently open.
@@ -235,6 +322,8 @@ def compare_document_spans(doc_id, source1, source2, spans1, spans2, options):
                         matched_s2.add(s2)
                         stats.add_tp(source1, source2, s1)
                         stats.add_tp(source2, source1, s2)
+                        stats.add_serial_agreement(source1, source2, s1, s2)
+                        stats.add_serial_agreement(source2, source1, s2, s1)
                     elif s1.overlap_matches(s2):
                         stats.add_overlap(source1, source2, s1, s2)
             open_spans[span] = True
@@ -253,19 +342,123 @@ def compare_document_spans(doc_id, source1, source2, spans1, spans2, options):
     return stats
 
     
+def compare_document_spans_one_to_one(doc_id, source1, source2, spans1,
+                                      spans2, options):
+    # Match each span at most once: first pair spans with identical
+    # boundaries and types by hashing, then (with options.overlap)
+    # greedily pair the remaining spans by decreasing overlap. As in
+    # the default sweep, overlapping spans of the same type that are not
+    # paired are counted as OVERLAP, including ones that overlap an
+    # exactly matched span. Overlapping spans are found with an interval
+    # index, so time is near-linear in the number of overlapping pairs.
+    stats = Stats([source1, source2])
+    exact_key = lambda s: (s.start, s.end, s.type.lower())
+    by_key = defaultdict(list)
+    for s2 in spans2:
+        by_key[exact_key(s2)].append(s2)
+    matches, unmatched_s1 = [], []
+    for s1 in spans1:
+        candidates = by_key.get(exact_key(s1))
+        if candidates:
+            matches.append((s1, candidates.pop(0)))
+        else:
+            unmatched_s1.append(s1)
+    unmatched_s2 = [s2 for c in by_key.values() for s2 in c]
+
+    index = IntervalIndex(spans2)
+    unmatched1, unmatched2 = set(unmatched_s1), set(unmatched_s2)
+    overlapping, candidates = [], []
+    for i, s1 in enumerate(spans1):
+        for s2 in index.overlapping(s1.start, s1.end):
+            if not s1.type_matches(s2) or s1.span_matches(s2):
+                continue
+            overlapping.append((s1, s2))
+            if options.overlap and s1 in unmatched1 and s2 in unmatched2:
+                overlap = min(s1.end, s2.end) - max(s1.start, s2.start) + 1
+                candidates.append((-overlap, s1.start, s2.start, i, s1, s2))
+    candidates.sort(key=lambda c: c[:4])
+    matched_s1, matched_s2, paired = set(), set(), set()
+    for _, _, _, _, s1, s2 in candidates:
+        if s1 in matched_s1 or s2 in matched_s2:
+            continue
+        matched_s1.add(s1)
+        matched_s2.add(s2)
+        paired.add((s1, s2))
+        matches.append((s1, s2))
+    for s1, s2 in overlapping:
+        if (s1, s2) not in paired:
+            stats.add_overlap(source1, source2, s1, s2)
+
+    for s1, s2 in matches:
+        stats.add_tp(source1, source2, s1)
+        stats.add_tp(source2, source1, s2)
+        stats.add_serial_agreement(source1, source2, s1, s2)
+        stats.add_serial_agreement(source2, source1, s2, s1)
+    for s1 in unmatched_s1:
+        if s1 not in matched_s1:
+            stats.add_fp(source2, source1, s1)
+            stats.add_fn(source1, source2, s1)
+    for s2 in unmatched_s2:
+        if s2 not in matched_s2:
+            stats.add_fp(source1, source2, s2)
+            stats.add_fn(source2, source1, s2)
+    return stats
+
+
+def format_scores(stats, sources, type_=None):
+    tp = stats.true_positive(sources, type_)
+    fp = stats.false_positive(sources, type_)
+    fn = stats.false_negative(sources, type_)
+    prec = stats.precision(sources, type_)
+    rec = stats.recall(sources, type_)
+    f = stats.f_score(sources, type_)
+    return (f'TP: {tp} FP: {fp} FN: {fn} '
+            f'prec: {prec:.1%} rec: {rec:.1%} fscore: {f:.1%}')
+
+
+def text_counters(stats, sources):
+    """Return per-text counters for sources by kind (tp, fp, fn, overlap)."""
+    return {
+        'tp': stats.tp_by_source_and_text[sources],
+        'fp': stats.fp_by_source_and_text[sources],
+        'fn': stats.fn_by_source_and_text[sources],
+        'overlap': stats.overlap_by_source_and_text[sources],
+    }
+
+
+def top_texts_guaranteed(stats, sources, number=TOP_TEXTS):
+    """Return whether the number most common texts of each kind reported
+    for sources are guaranteed correct, by kind. This always holds for
+    exact counters; for approximate ones, counts are within error()."""
+    return {
+        kind: (counter.guaranteed(number)
+               if isinstance(counter, SpaceSavingCounter) else True)
+        for kind, counter in text_counters(stats, sources).items()
+    }
+
+
 def save_results(path, stats, options):
-    with open_file(path, 'w', options) as out:
+    with atomic_open(path, 'w', **encoding_args(options)) as out:
         for sources in sorted(stats.sources()):
             print(f'GOLD: {sources[0]}, PRED: {sources[1]}', file=out)
-            tp = stats.true_positive(sources)
-            fp = stats.false_positive(sources)
-            fn = stats.false_negative(sources)
-            prec = stats.precision(sources)
-            rec = stats.recall(sources)
-            f = stats.f_score(sources)
-            print(f'FP: {tp} FP: {fp} FN: {fn} '
-                  f'prec: {prec:.1%} rec: {rec:.1%} fscore: {f:.1%}', 
-                  file=out)
+            print(format_scores(stats, sources), file=out)
+            for type_ in stats.types(sources):
+                print(f'TYPE {type_}: {format_scores(stats, sources, type_)}',
+                      file=out)
+            agreement = stats.serial_agreement(sources)
+            print(f'SERIALS: pairs: {agreement["pairs"]} '
+                  f'exact: {agreement["exact"]:.1%} '
+                  f'any-overlap: {agreement["overlap"]:.1%} '
+                  f'jaccard: {agreement["jaccard"]:.3f}', file=out)
+            if options.text_counter != 'exact':
+                guaranteed = top_texts_guaranteed(stats, sources)
+                for kind in (k for k, g in guaranteed.items() if not g):
+                    warning(f'top {kind.upper()} texts for {sources[0]}, '
+                            f'{sources[1]} are not guaranteed, consider '
+                            f'increasing --text-counter-capacity')
+                print('GUARANTEED: ' + ' '.join(
+                    f'{k}: {"yes" if g else "no"}'
+                    for k, g in guaranteed.items()), file=out)
             for text, count in stats.most_common_tp(sources):
                 print(f'TP:\t{count}\t{text}', file=out)
             for text, count in stats.most_common_fp(sources):
@@ -277,6 +470,67 @@ def save_results(path, stats, options):
     print(f'saved results in {path}', file=sys.stderr, flush=True)
 
 
+def most_common_json(counter, number=TOP_TEXTS):
+    if isinstance(counter, SpaceSavingCounter):
+        error = counter.error
+    else:
+        error = lambda text: 0
+    return [
+        { 'text': text, 'count': count, 'error': error(text) }
+        for text, count in counter.most_common(number)
+    ]
+
+
+def save_json_results(path, stats, doc_count, options):
+    results = { 'documents': doc_count, 'pairs': [] }
+    for sources in sorted(stats.sources()):
+        overlaps = most_common_json(stats.overlap_by_source_and_text[sources])
+        for o in overlaps:
+            o['gold_text'], o['pred_text'] = o.pop('text').split('\t')
+        results['pairs'].append({
+            'gold': sources[0],
+            'pred': sources[1],
+            'tp': stats.true_positive(sources),
+            'fp': stats.false_positive(sources),
+            'fn': stats.false_negative(sources),
+            'precision': stats.precision(sources),
+            'recall': stats.recall(sources),
+            'f_score': stats.f_score(sources),
+            'serials': stats.serial_agreement(sources),
+            'by_type': {
+                type_: {
+                    'tp': stats.true_positive(sources, type_),
+                    'fp': stats.false_positive(sources, type_),
+                    'fn': stats.false_negative(sources, type_),
+                    'precision': stats.precision(sources, type_),
+                    'recall': stats.recall(sources, type_),
+                    'f_score': stats.f_score(sources, type_),
+                }
+                for type_ in stats.types(sources)
+            },
+            'most_common': {
+                'tp': most_common_json(stats.tp_by_source_and_text[sources]),
+                'fp': most_common_json(stats.fp_by_source_and_text[sources]),
+                'fn': most_common_json(stats.fn_by_source_and_text[sources]),
+                'overlap': overlaps,
+            },
+            'most_common_guaranteed': top_texts_guaranteed(stats, sources),
+        })
+    with atomic_open(path, 'w') as out:
+        json.dump(results, out, indent=2)
+    print(f'saved results in {path}', file=sys.stderr, flush=True)
+
+
+def write_document_stats(doc, doc_stats, out):
+    """Write TSV rows with document TP/FP/FN counts for source pairs."""
+    for sources in sorted(doc_stats.sources()):
+        tp = doc_stats.true_positive(sources)
+        fp = doc_stats.false_positive(sources)
+        fn = doc_stats.false_negative(sources)
+        out.write(f'{doc.id}\t{sources[0]}\t{sources[1]}\t'
+                  f'{tp}\t{fp}\t{fn}\n')
+
+
 def select_document_for_output(doc, doc_stats, options):
     """Return whether to include document in output."""
     sources = sorted(doc_stats.sources())[0]    # arbitrary but fixed
@@ -307,42 +561,238 @@ def select_document_for_output(doc, doc_stats, options):
         return True
 
 
-def compare_spans(doc_fn, tag_fns, names, doc_out, tag_out, options):
+def sort_by_doc_id(stream, options):
+    buffer_size = options.sort_buffer * 2**20
+    return SortedLineStream(stream, line_doc_id_key, options, buffer_size,
+                            options.tmpdir)
+
+
+def make_text_counter(options):
+    if options.text_counter == 'exact':
+        return Counter
+    else:
+        return partial(SpaceSavingCounter, options.text_counter_capacity)
+
+
+def open_input(fn, options, position=None):
+    if options.checkpoint is None:
+        return open_file(fn, 'r', options)
+    else:
+        # track offsets for checkpoints
+        offset = position[0] if position is not None else 0
+        return TrackedLineReader(fn, options, offset)
+
+
+def save_checkpoint(path, doc_count, stats, readers, outputs):
+    state = {
+        'inputs': [r.stream.name for r in readers],
+        'doc_count': doc_count,
+        'stats': stats,
+        'random_state': random.getstate(),
+        'input_positions': [
+            (r.stream.lookahead_offset(), r.iter.index) for r in readers
+        ],
+        'output_positions': [o.tell() for o in outputs],
+    }
+    with atomic_open(path, 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    print(f'saved checkpoint in {path}', file=sys.stderr, flush=True)
+
+
+def load_checkpoint(path, inputs):
+    with open(path, 'rb') as f:
+        state = pickle.load(f)
+    if state['inputs'] != inputs:
+        raise ValueError(f'checkpoint {path} is for inputs {state["inputs"]}')
+    print(f'resuming from {path} after {state["doc_count"]} documents',
+          file=sys.stderr, flush=True)
+    return state
+
+
+def save_progress(doc_count, stats, readers, outputs, options):
+    save_results(options.output, stats, options)
+    if options.json_output:
+        save_json_results(options.json_output, stats, doc_count, options)
+    for output in outputs:
+        output.flush()
+    if options.text_counter == 'exact':
+        stats.trim()
+    if options.checkpoint:
+        save_checkpoint(options.checkpoint, doc_count, stats, readers,
+                        outputs)
+
+
+def prepare_spans(doc, spans, options):
+    """Validate, filter and deduplicate spans of document."""
+    with profiler.stage('validate'):
+        spans = validate_spans(doc.id, doc.text, spans)
+    with profiler.stage('filter'):
+        spans = filter_spans(spans, options)
+        spans = deduplicate_spans(spans)
+    return spans
+
+
+def content_hash(lines):
+    digest = hashlib.blake2b(digest_size=16)
+    for line in lines:
+        digest.update(line.encode('utf-8', 'surrogateescape'))
+    return digest.hexdigest()
+
+
+class ComparisonCache:
+    """On-disk cache of per-document Stats for pairs of sources, keyed
+    by document ID, hashes of the document text and the span lines of
+    both sources, and the options affecting comparison."""
+
+    VERSION = 1
+
+    def __init__(self, path, options):
+        self.db = shelve.open(path, protocol=pickle.HIGHEST_PROTOCOL)
+        key_options = {
+            'version': self.VERSION,
+            'overlap': options.overlap,
+            'one_to_one': options.one_to_one,
+            'char_offsets': options.char_offsets,
+            'types': sorted(options.types) if options.types else None,
+        }
+        self.options_hash = content_hash([json.dumps(key_options)])
+        self.hits = self.misses = 0
+
+    def key(self, doc_id, text_hash, name1, hash1, name2, hash2):
+        return '\t'.join([doc_id, text_hash, name1, hash1, name2, hash2,
+                          self.options_hash])
+
+    def get(self, key):
+        stats = self.db.get(key)
+        if stats is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return stats
+
+    def put(self, key, stats):
+        self.db[key] = stats
+
+    def close(self):
+        self.db.close()
+        total = self.hits + self.misses
+        if total:
+            print(f'comparison cache: {self.hits}/{total} hits '
+                  f'({self.hits/total:.1%})', file=sys.stderr)
+
+
+class DocumentSpans:
+    """Spans of a document by source, prepared when first needed. With
+    a cache, holds the lines of each source until they are needed."""
+
+    def __init__(self, doc, spans, span_readers, options, cache=None):
+        self.doc = doc
+        self.span_readers = span_readers
+        self.options = options
+        if cache is None:
+            self.lines = None
+            self.prepared = [prepare_spans(doc, s, options) for s in spans]
+        else:
+            self.lines = spans
+            self.prepared = [None] * len(spans)
+            with profiler.stage('hash'):
+                self.text_hash = content_hash([doc.text])
+                self.hashes = [content_hash(lines) for lines in spans]
+
+    def __getitem__(self, i):
+        if self.prepared[i] is None:
+            spans = self.span_readers[i].parse_lines(self.lines[i])
+            self.prepared[i] = prepare_spans(self.doc, spans, self.options)
+        return self.prepared[i]
+
+    def __len__(self):
+        return len(self.prepared)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+def compare_document_pair(doc_spans, i, j, names, options, cache=None):
+    """Return Stats comparing sources i and j of DocumentSpans."""
+    key = None
+    if cache is not None:
+        key = cache.key(doc_spans.doc.id, doc_spans.text_hash,
+                        names[i], doc_spans.hashes[i],
+                        names[j], doc_spans.hashes[j])
+        doc_stats = cache.get(key)
+        if doc_stats is not None:
+            return doc_stats
+    with profiler.stage('compare'):
+        doc_stats = compare_document_spans(
+            doc_spans.doc.id, names[i], names[j], doc_spans[i],
+            doc_spans[j], options)
+    if cache is not None:
+        cache.put(key, doc_stats)
+    return doc_stats
+
+
+def compare_spans(doc_fn, tag_fns, names, doc_out, tag_out, options,
+                  checkpoint=None, doc_stats_out=None, cache=None):
     if names is None:
         names = tag_fns
-    doc_count = 0
-    stats = Stats(names)
-    with open_file(doc_fn, 'r', options) as doc_f:
-        doc_reader = DocReader(doc_f)
+    if checkpoint is None:
+        doc_count = 0
+        stats = Stats(names, make_text_counter(options))
+        positions = [None] * (len(tag_fns)+1)
+    else:
+        doc_count = checkpoint['doc_count']
+        stats = checkpoint['stats']
+        random.setstate(checkpoint['random_state'])
+        positions = checkpoint['input_positions']
+    start_line = lambda p: p[1] if p is not None else 1
+    with ExitStack() as stack:
+        doc_f = stack.enter_context(
+            open_input(doc_fn, options, positions[0]))
         tag_fs = []
-        for tag_fn in tag_fns:
-            tag_fs.append(open_file(tag_fn, 'r', options))
+        for tag_fn, position in zip(tag_fns, positions[1:]):
+            tag_fs.append(stack.enter_context(
+                open_input(tag_fn, options, position)))
+        if options.sort_inputs:
+            doc_f = sort_by_doc_id(doc_f, options)
+            tag_fs = [sort_by_doc_id(tag_f, options) for tag_f in tag_fs]
+            for f in [doc_f] + tag_fs:
+                stack.callback(f.close)
+        doc_reader = DocReader(doc_f, start_line=start_line(positions[0]))
         span_readers = [
-            SpanReader(tag_f, source=name) 
-            for tag_f, name in zip(tag_fs, names)
+            SpanReader(tag_f, source=name, start_line=start_line(position))
+            for tag_f, name, position in zip(tag_fs, names, positions[1:])
         ]
-        for doc_idx, doc in enumerate(doc_reader):
+        # with a cache, read lines and parse only on cache misses
+        parse = cache is None
+        if options.merge_join or options.sort_inputs:
+            documents = merge_join_documents(doc_reader, span_readers, parse)
+        else:
+            documents = iter_documents_with_spans(doc_reader, span_readers,
+                                                  parse=parse)
+        for doc_idx, (doc, spans) in enumerate(documents):
             if options.max_docs and doc_count >= options.max_docs:
                 break
-            spans = [r.document_spans(doc.id) for r in span_readers]
-            spans = [validate_spans(doc.id, doc.text, s) for s in spans]
-            spans = [filter_spans(s, options) for s in spans]
-            spans = [deduplicate_spans(s, options) for s in spans]
+            spans = DocumentSpans(doc, spans, span_readers, options, cache)
             selected_for_output = False
             for i in range(len(spans)):
                 for j in range(i+1, len(spans)):
-                    doc_stats = compare_document_spans(
-                        doc.id, names[i], names[j], spans[i], spans[j],
-                        options)
-                    stats.add_stats(doc_stats)
+                    doc_stats = compare_document_pair(spans, i, j, names,
+                                                      options, cache)
+                    with profiler.stage('compare'):
+                        stats.add_stats(doc_stats)
+                    if doc_stats_out is not None:
+                        with profiler.stage('write'):
+                            write_document_stats(doc, doc_stats,
+                                                 doc_stats_out)
                     if select_document_for_output(doc, doc_stats, options):
                         selected_for_output = True
 
             if (selected_for_output and
                 (options.sample is None or random.random() < options.sample)):
-                print(doc, file=doc_out)
-                for s in (s for sp in spans for s in sp):
-                    print(s, file=tag_out)
+                with profiler.stage('write'):
+                    doc_out.write_document(doc)
+                    for s in (s for sp in spans for s in sp):
+                        tag_out.write_span(s)
 
             doc_count += 1
             if doc_count % 10000 == 0:
@@ -350,12 +800,16 @@ def compare_spans(doc_fn, tag_fns, names, doc_out, tag_out, options):
                       flush=True)
             if (options.save_interval and 
                 doc_count % options.save_interval == 0):
-                save_results(options.output, stats, options)
-                doc_out.flush()
-                tag_out.flush()
-                stats.trim()
+                outputs = [doc_out, tag_out]
+                if doc_stats_out is not None:
+                    outputs.append(doc_stats_out)
+                with profiler.stage('save'):
+                    save_progress(doc_count, stats, [doc_reader]+span_readers,
+                                  outputs, options)
 
     save_results(options.output, stats, options)
+    if options.json_output:
+        save_json_results(options.json_output, stats, doc_count, options)
 
 
 def main(argv):
@@ -366,12 +820,47 @@ def main(argv):
             raise ValueError('number of names != number of tag inputs')
     if args.types is not None:
         args.types = set(t.lower() for t in args.types.split(','))
+    if args.checkpoint and not args.save_interval:
+        raise ValueError('--checkpoint requires --save-interval')
+    if args.checkpoint and args.sort_inputs:
+        raise ValueError('--checkpoint not supported with --sort-inputs')
+    if args.checkpoint and args.read_ahead:
+        raise ValueError('--checkpoint not supported with --read-ahead')
+    if args.resume and not args.checkpoint:
+        raise ValueError('--resume requires --checkpoint')
     random.seed(args.seed)
 
-    with open_file(args.doc_output, 'w', args) as doc_out:
-        with open_file(args.tag_output, 'w', args) as tag_out:
-            compare_spans(args.docs, args.tags, args.names, doc_out, tag_out,
-                          args)
+    if args.resume:
+        checkpoint = load_checkpoint(args.checkpoint, [args.docs] + args.tags)
+        mode = 'a'
+    else:
+        checkpoint = None
+        mode = 'w'
+    with ExitStack() as stack:
+        stack.enter_context(profiling(args))
+        doc_out = stack.enter_context(open_writer(args.doc_output, args, mode))
+        tag_out = stack.enter_context(open_writer(args.tag_output, args, mode))
+        outputs = [doc_out, tag_out]
+        if args.doc_stats_output is None:
+            doc_stats_out = None
+        else:
+            doc_stats_out = stack.enter_context(
+                open_writer(args.doc_stats_output, args, mode))
+            outputs.append(doc_stats_out)
+        if checkpoint is not None:
+            # discard output written after the checkpoint
+            positions = checkpoint['output_positions']
+            if len(positions) != len(outputs):
+                raise ValueError('outputs differ from checkpoint')
+            for output, position in zip(outputs, positions):
+                output.truncate(position)
+        if args.cache is None:
+            cache = None
+        else:
+            cache = ComparisonCache(args.cache, args)
+            stack.callback(cache.close)
+        compare_spans(args.docs, args.tags, args.names, doc_out, tag_out,
+                      args, checkpoint, doc_stats_out, cache)
     return 0
 
 
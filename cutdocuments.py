@@ -3,43 +3,240 @@
 """Cut parts out of STRING DB database_documents.tsv format."""
 
 import sys
+import re
 
-from argparse import ArgumentParser
+from functools import lru_cache
+from contextlib import nullcontext
+from argparse import ArgumentParser, ArgumentTypeError
 
-from common import DocReader, open_file, safe_str
+from common import DocReader, LookaheadIterator, open_file
+from common import profiler, profiling, add_profile_arguments
+from common import add_input_arguments, add_output_arguments
+from common import add_shard_arguments, open_sharded_writer
+
+
+# Named cuts and the (0-based) tab-separated sections they retain
+NAMED_CUTS = {
+    'tiab': 'sections:0-1',
+    'title': 'sections:0',
+    'abstract': 'sections:1',
+    'body': 'sections:2-',
+}
+
+CUT_HELP = (
+    ', '.join(NAMED_CUTS) + ', sections:RANGES (e.g. sections:0,2-4), '
+    'first:N (first N sections), drop:REGEX (drop sections matching REGEX) '
+    'or maxbytes:N (at most N bytes, or characters with --char-offsets, '
+    'ending at a sentence or section boundary)'
+)
+
+# Ends of sentences for maxbytes cuts
+SENTENCE_END_RE = re.compile(r'[.!?](?=\s)|(?=\t)')
 
 
 def argparser():
     ap = ArgumentParser()
     ap.add_argument('--char-offsets', default=False, action='store_true',
                     help='offsets are character- instead of byte-based')
-    ap.add_argument('--cut', choices=['tiab'], default='tiab',
-                    help='Which part of documents to cut')
+    ap.add_argument('--cut', type=cut_argument, default='tiab',
+                    help=f'Which part of documents to cut: {CUT_HELP}')
+    ap.add_argument('--section-index', default=None,
+                    help='section index for documents (see sectionindex.py; '
+                    'only saves finding sections, documents are still read '
+                    'in full, so pays off only when reused across runs)')
+    add_input_arguments(ap)
+    add_profile_arguments(ap)
+    add_output_arguments(ap)
+    add_shard_arguments(ap)
     ap.add_argument('docs', help='documents in database_documents.tsv format')
     ap.add_argument('out', help='output file for cut documents')
     return ap
 
 
-def cut_document(doc, options):
-    if options.cut == 'tiab':
-        # restrict to title and abstract
-        sections = doc.text.split('\t')
-        if len(sections) > 2:
-            doc.text = '\t'.join(sections[:2])
-            return True
+def parse_section_ranges(ranges, cut):
+    parsed = []
+    for range_ in ranges.split(','):
+        first, dash, last = range_.partition('-')
+        try:
+            first = int(first)
+            if not dash:
+                last = first
+            else:
+                last = int(last) if last else None
+        except ValueError:
+            raise ValueError(f'invalid section range {range_} in {cut}')
+        parsed.append((first, last))
+    return parsed
+
+
+@lru_cache(maxsize=None)
+def parse_cut(cut):
+    """Return (mode, argument) for cut. Section-based cuts have mode
+    'sections' and a list of (first, last) section index ranges, where
+    last is None for ranges extending to the end of the text."""
+    mode, _, arg = NAMED_CUTS.get(cut, cut).partition(':')
+    try:
+        if mode == 'sections' and arg:
+            return mode, parse_section_ranges(arg, cut)
+        elif mode == 'first':
+            return 'sections', [(0, int(arg)-1)]
+        elif mode == 'drop':
+            return mode, re.compile(arg)
+        elif mode == 'maxbytes':
+            return mode, int(arg)
+    except (ValueError, re.error) as e:
+        raise ValueError(f'invalid cut {cut}: {e}')
+    raise ValueError(f'invalid cut {cut}')
+
+
+def cut_argument(cut):
+    try:
+        parse_cut(cut)
+    except ValueError as e:
+        raise ArgumentTypeError(str(e))
+    return cut
+
+
+def section_offsets(text):
+    """Return (start, end) offsets of tab-separated sections of text."""
+    sections, start = [], 0
+    while True:
+        end = text.find('\t', start)
+        if end == -1:
+            sections.append((start, len(text)))
+            return sections
+        sections.append((start, end))
+        start = end + 1
+
+
+class SectionIndex:
+    """Reader for section index files written by sectionindex.py.
+
+    The index lists documents in the same order as the documents file,
+    one per line as the document ID and comma-separated section ends.
+    Documents must be looked up in index order, and ValueError is
+    raised if the index and documents differ.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.iter = LookaheadIterator(stream)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        self.stream.close()
+        if exc_type is None and self.iter:
+            raise ValueError(f'section index has extra documents from '
+                             f'{self._lookahead_id()} on line '
+                             f'{self.iter.index+1}')
+
+    def _lookahead_id(self):
+        return self.iter.lookahead.split('\t', 1)[0]
+
+    def document_sections(self, doc_id, text):
+        """Return section offsets for document doc_id. Raises ValueError
+        if doc_id is not next in the index or the index does not match
+        text."""
+        if not self.iter:
+            raise ValueError(f'document {doc_id} missing from section index')
+        if self._lookahead_id() != doc_id:
+            raise ValueError(f'section index has {self._lookahead_id()} '
+                             f'instead of document {doc_id} on line '
+                             f'{self.iter.index+1}')
+        ends = next(self.iter).rstrip('\n').split('\t')[1].split(',')
+        sections, start = [], 0
+        for end in ends:
+            sections.append((start, int(end)))
+            start = int(end) + 1
+        if sections[-1][1] != len(text) or any(
+                text[end] != '\t' for start, end in sections[:-1]):
+            raise ValueError(f'section index does not match document '
+                             f'{doc_id} on line {self.iter.index}')
+        return sections
+
+
+def maxbytes_segments(text, max_len):
+    end = 0
+    for m in SENTENCE_END_RE.finditer(text, 0, max_len+1):
+        if m.end() > max_len:
+            break
+        end = m.end()
+    return [(0, end)] if end > 0 else []
+
+
+def cut_segments(text, cut, sections=None):
+    """Return (start, end) segments of text retained by cut, or None if
+    nothing is cut. Adjacent retained sections form a single segment."""
+    mode, arg = parse_cut(cut)
+    if mode == 'maxbytes':
+        if len(text) <= arg:
+            return None
+        return maxbytes_segments(text, arg)
+    if sections is None:
+        sections = section_offsets(text)
+    if mode == 'sections':
+        retained = [
+            section for index, section in enumerate(sections)
+            if any(first <= index and (last is None or index <= last)
+                   for first, last in arg)
+        ]
+    elif mode == 'drop':
+        retained = [
+            (start, end) for start, end in sections
+            if not arg.search(text[start:end])
+        ]
     else:
-        raise ValueError(options.cut)
-    return False
+        raise ValueError(cut)
+    segments = []
+    for start, end in retained:
+        if segments and segments[-1][1] == start-1:
+            segments[-1] = (segments[-1][0], end)
+        else:
+            segments.append((start, end))
+    if segments == [(0, len(text))]:
+        return None
+    return segments
+
+
+def cut_text(text, segments):
+    return '\t'.join(text[start:end] for start, end in segments)
+
+
+def document_cut_segments(doc, options, section_index=None):
+    """Return segments of document retained by cut or None if not cut."""
+    sections = None
+    if section_index is not None:
+        sections = section_index.document_sections(doc.id, doc.text)
+    return cut_segments(doc.text, options.cut, sections)
+
+
+def cut_document(doc, options, section_index=None):
+    segments = document_cut_segments(doc, options, section_index)
+    if segments is None:
+        return False
+    doc.text = cut_text(doc.text, segments)
+    return True
+
+
+def open_section_index(options):
+    if options.section_index is None:
+        return nullcontext()
+    return SectionIndex(open_file(options.section_index, 'r', options))
 
 
 def cut_documents(doc_fn, out_fn, options):
     cut_count = 0
     with open_file(doc_fn, 'r', options) as doc_f:
         doc_reader = DocReader(doc_f)
-        with open_file(out_fn, 'w', options) as out_f:
+        with open_section_index(options) as section_index, \
+             open_sharded_writer(out_fn, options) as out:
             for doc_idx, doc in enumerate(doc_reader):
-                cut_count += cut_document(doc, options)
-                print(doc, file=out_f)
+                with profiler.stage('cut'):
+                    cut_count += cut_document(doc, options, section_index)
+                with profiler.stage('write'):
+                    out.writer(doc.id).write_document(doc)
                 if (doc_idx+1) % 100000 == 0:
                     print(f'processed {doc_idx+1} documents',
                           file=sys.stderr)
@@ -49,7 +246,8 @@ def cut_documents(doc_fn, out_fn, options):
 
 def main(argv):
     args = argparser().parse_args(argv[1:])
-    cut_documents(args.docs, args.out, args)
+    with profiling(args):
+        cut_documents(args.docs, args.out, args)
     return 0
 
 
@@ -4,88 +4,138 @@
 
 import sys
 
-from argparse import ArgumentParser
+from argparse import ArgumentParser, Namespace
+from contextlib import ExitStack
 from logging import warning
 
-from common import DocReader, SpanReader, open_file, safe_str
+from common import iter_documents_with_spans, parse_stringdb_span_line
+from common import SegmentOffsetMap, filter_norms, open_file
+from common import add_output_arguments, register_stage
+from common import add_shard_arguments, open_sharded_writer
+from cutdocuments import cut_argument, parse_cut, cut_segments, cut_text
+from cutdocuments import document_cut_segments, open_section_index, CUT_HELP
+from common import profiler, profiling, add_profile_arguments
+from common import add_input_arguments
 
 
 def argparser():
     ap = ArgumentParser()
     ap.add_argument('--char-offsets', default=False, action='store_true',
                     help='offsets are character- instead of byte-based')
-    ap.add_argument('--cut', choices=['tiab'], default='tiab',
-                    help='Which part of documents to cut')
+    ap.add_argument('--cut', type=cut_argument, default='tiab',
+                    help=f'Which part of documents to cut: {CUT_HELP}')
+    ap.add_argument('--section-index', default=None,
+                    help='section index for documents (see sectionindex.py; '
+                    'only saves finding sections, documents are still read '
+                    'in full, so pays off only when reused across runs)')
+    ap.add_argument('--doc-out', default=None,
+                    help='also write cut documents to file in the same pass')
+    add_input_arguments(ap)
+    add_profile_arguments(ap)
+    add_output_arguments(ap)
+    add_shard_arguments(ap)
     ap.add_argument('docs', help='documents in database_documents.tsv format')
     ap.add_argument('tags', help='tagged strings in all_matches.tsv format')
-    ap.add_argument('out', help='output file for cut documents')
+    ap.add_argument('out', help='output file for cut tags')
     return ap
 
 
-def get_offset_map(doc, options):
+def get_offset_map(segments):
     """Return mapping from original to cut document text offsets or None
     if the text is not cut."""
-    if options.cut == 'tiab':
-        # restrict to title and abstract
-        sections = doc.text.split('\t')
-        if len(sections) <= 2:
-            return None
-        else:
-            tiab = '\t'.join(sections[:2])
-            cut_text = doc.text[len(tiab):]
-            offset_map = list(range(len(tiab))) + [None] * len(cut_text)
-            return offset_map
-    else:
-        raise ValueError(options.cut)
+    if segments is None:
+        return None
+    return SegmentOffsetMap(segments)
 
 
 def apply_offset_map(spans, offset_map):
     mapped_spans = []
     for span in spans:
-        start, end = offset_map[span.start], offset_map[span.end]
-        if start is not None and end is not None:
+        try:
+            mapped = offset_map.map_span(span.start, span.end)
+        except ValueError:
+            warning(f'span cut partially: {span}')
+            continue
+        if mapped is not None:
             # mapped span included in remaining text, map and retain
-            span.start, span.end = start, end
+            span.start, span.end = mapped
             mapped_spans.append(span)
-        elif start is None and end is None:
-            pass    # span was cut entirely from text
         else:
-            warning('span cut partially: {span}')
+            pass    # span was cut entirely from text
     return mapped_spans
 
 
+@register_stage('cut')
+def cut_stage(cut, options):
+    """Pipeline stage cutting documents and their spans. As in cut_tags(),
+    norms are filtered from spans of documents that are cut."""
+    cut_options = Namespace(**vars(options))
+    cut_options.cut = cut or 'tiab'
+    parse_cut(cut_options.cut)    # validate
+    def cut_document_and_spans(doc, spans):
+        segments = cut_segments(doc.text, cut_options.cut)
+        if segments is not None:
+            spans = apply_offset_map(spans, SegmentOffsetMap(segments))
+            for span in spans:
+                span.serials = filter_norms(span.serials)
+            doc.text = cut_text(doc.text, segments)
+        return doc, spans
+    return cut_document_and_spans
+
+
 def cut_tags(doc_fn, tag_fn, out_fn, options):
-    removed, total = 0, 0
-    with open_file(doc_fn, 'r', options) as doc_f:
-        doc_reader = DocReader(doc_f)
-        with open_file(tag_fn, 'r', options) as tag_f:
-            span_reader = SpanReader(tag_f, no_type_mapping=True)
-            with open_file(out_fn, 'w', options) as out_f:
-                for doc_idx, doc in enumerate(doc_reader):
-                    offset_map = get_offset_map(doc, options)
-                    if offset_map is None:
-                        # no-op, quick copy without parsing
-                        for span in span_reader.document_lines(doc.id):
-                            print(span, end='', file=out_f)
-                            total += 1
-                    else:
-                        # need to parse, map and filter
-                        spans = list(span_reader.document_spans(doc.id))
-                        mapped = apply_offset_map(spans, offset_map)
-                        removed += len(spans) - len(mapped)
-                        total += len(spans)
-                        for span in mapped:
-                            print(span, file=out_f)
-                    if (doc_idx+1) % 100000 == 0:
-                        print(f'processed {doc_idx+1} documents',
-                              file=sys.stderr)
-    print(f'removed {removed}/{total} spans ({removed/total:.1%})',
-          file=sys.stderr)
+    removed, total, cut_count = 0, 0, 0
+    with ExitStack() as stack:
+        doc_f = stack.enter_context(open_file(doc_fn, 'r', options))
+        tag_f = stack.enter_context(open_file(tag_fn, 'r', options))
+        section_index = stack.enter_context(open_section_index(options))
+        tag_out = stack.enter_context(open_sharded_writer(out_fn, options))
+        doc_out = None
+        if options.doc_out is not None:
+            doc_out = open_sharded_writer(options.doc_out, options)
+            stack.enter_context(doc_out)
+        documents = iter_documents_with_spans(doc_f, [tag_f], parse=False)
+        for doc_idx, (doc, (lines,)) in enumerate(documents):
+            with profiler.stage('cut'):
+                segments = document_cut_segments(doc, options, section_index)
+                offset_map = get_offset_map(segments)
+            out_f = tag_out.writer(doc.id)
+            if offset_map is None:
+                # no-op, quick copy without parsing
+                with profiler.stage('write'):
+                    for span in lines:
+                        out_f.write(span)
+                total += len(lines)
+            else:
+                # need to parse, map and filter
+                with profiler.stage('parse'):
+                    spans = [
+                        parse_stringdb_span_line(line, no_type_mapping=True)
+                        for line in lines
+                    ]
+                with profiler.stage('cut'):
+                    mapped = apply_offset_map(spans, offset_map)
+                    if doc_out is not None:
+                        doc.text = cut_text(doc.text, segments)
+                removed += len(spans) - len(mapped)
+                total += len(spans)
+                cut_count += 1
+                with profiler.stage('write'):
+                    for span in mapped:
+                        out_f.write_span(span)
+            if doc_out is not None:
+                with profiler.stage('write'):
+                    doc_out.writer(doc.id).write_document(doc)
+            if (doc_idx+1) % 100000 == 0:
+                print(f'processed {doc_idx+1} documents', file=sys.stderr)
+    print(f'removed {removed}/{total} spans ({removed/total:.1%}), '
+          f'cut {cut_count} documents', file=sys.stderr)
 
 
 def main(argv):
     args = argparser().parse_args(argv[1:])
-    cut_tags(args.docs, args.tags, args.out, args)
+    with profiling(args):
+        cut_tags(args.docs, args.tags, args.out, args)
     return 0
 
 
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+"""
+Compare two releases of STRING DB all_matches.tsv format by document.
+
+Outputs DOC_ID STATUS lines for documents whose spans were added,
+removed or changed between the releases. Lines are compared without
+parsing and regardless of their order within a document. Both inputs
+must be ordered by document ID (see sorttags.py) unless --sort-inputs
+is given. The output can be given to tagger2standoff.py --only-changed.
+"""
+
+import sys
+
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from collections import Counter
+
+from common import SpanReader, MergeJoinReader, SortedLineStream
+from common import line_doc_id_key, open_file, open_writer
+from common import profiler, profiling, add_profile_arguments
+from common import add_input_arguments
+from common import add_output_arguments
+
+
+ADDED, REMOVED, CHANGED, UNCHANGED = 'added', 'removed', 'changed', 'unchanged'
+
+
+def argparser():
+    ap = ArgumentParser(description=__doc__,
+                        formatter_class=RawDescriptionHelpFormatter)
+    ap.add_argument('--char-offsets', default=False, action='store_true',
+                    help='offsets are character- instead of byte-based')
+    ap.add_argument('--all', default=False, action='store_true',
+                    help='also output unchanged documents')
+    ap.add_argument('--ids-only', default=False, action='store_true',
+                    help='output only document IDs')
+    ap.add_argument('--sort-inputs', default=False, action='store_true',
+                    help='sort inputs by document ID first')
+    ap.add_argument('--sort-buffer', default=256, type=int, metavar='MB',
+                    help='memory for in-memory runs of --sort-inputs')
+    ap.add_argument('--tmpdir', default=None,
+                    help='directory for temporary files')
+    add_input_arguments(ap)
+    add_profile_arguments(ap)
+    add_output_arguments(ap)
+    ap.add_argument('old', help='old tags in all_matches.tsv format')
+    ap.add_argument('new', help='new tags in all_matches.tsv format')
+    ap.add_argument('out', help='output file ("-" for stdout)')
+    return ap
+
+
+def document_status(old_lines, new_lines):
+    if not old_lines:
+        return ADDED
+    elif not new_lines:
+        return REMOVED
+    elif old_lines == new_lines or sorted(old_lines) == sorted(new_lines):
+        return UNCHANGED
+    else:
+        return CHANGED
+
+
+def diff_tags(old_fn, new_fn, out_fn, options):
+    counts = Counter()
+    with open_file(old_fn, 'r', options) as old_f, \
+         open_file(new_fn, 'r', options) as new_f, \
+         open_writer(out_fn, options) as out:
+        if options.sort_inputs:
+            buffer_size = options.sort_buffer * 2**20
+            old_f, new_f = (
+                SortedLineStream(f, line_doc_id_key, options, buffer_size,
+                                 options.tmpdir)
+                for f in (old_f, new_f)
+            )
+        readers = [SpanReader(old_f), SpanReader(new_f)]
+        for doc_id, (old_lines, new_lines) in MergeJoinReader(readers, False):
+            with profiler.stage('compare'):
+                status = document_status(old_lines, new_lines)
+            counts[status] += 1
+            if status == UNCHANGED and not options.all:
+                continue
+            with profiler.stage('write'):
+                if options.ids_only:
+                    out.write_line(doc_id)
+                else:
+                    out.write_line(f'{doc_id}\t{status}')
+    summary = ', '.join(
+        f'{counts[s]} {s}' for s in (ADDED, REMOVED, CHANGED, UNCHANGED))
+    print(f'compared {sum(counts.values())} documents: {summary}',
+          file=sys.stderr)
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    with profiling(args):
+        diff_tags(args.old, args.new, args.out, args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
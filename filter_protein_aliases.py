@@ -5,6 +5,9 @@ import sys
 from collections import defaultdict
 from argparse import ArgumentParser
 
+from common import profiler, profiling, add_profile_arguments
+from common import write_alias_index
+
 
 # Prioritized list of sources to use to select aliases
 SOURCE_PRIORITY = [
@@ -18,13 +21,17 @@ TARGET_SOURCES = set(SOURCE_PRIORITY)
 
 def argparser():
     ap = ArgumentParser()
+    ap.add_argument('--index', default=None, metavar='FILE',
+                    help='write sorted protein ID to alias index to FILE '
+                    '(for tagger2standoff.py --aliases)')
+    add_profile_arguments(ap)
     ap.add_argument('file', help='protein.aliases.v<VER>.txt file')
     return ap
 
 
 def filter_protein_aliases(fn, options):
     filtered_aliases = defaultdict(list)
-    with open(fn) as f:
+    with profiler.stage('read'), open(fn) as f:
         next(f)    # skip header line
         for ln, l in enumerate(f, start=1):
             l = l.rstrip('\n')
@@ -32,17 +39,37 @@ def filter_protein_aliases(fn, options):
             for source in sources.split():
                 if source in TARGET_SOURCES:
                     filtered_aliases[protein_id].append((alias, source))
+            profiler.count(bytes_=len(l))
+    with profiler.stage('write'):
+        if options.index is None:
+            print_aliases(filtered_aliases)
+        else:
+            write_alias_index(options.index, (
+                (protein_id, alias) for protein_id, alias, source
+                in select_aliases(filtered_aliases)
+            ))
+            print(f'wrote {len(filtered_aliases)} aliases to {options.index}',
+                  file=sys.stderr)
+
+
+def select_aliases(filtered_aliases):
     for protein_id, aliases_and_sources in filtered_aliases.items():
         sorted_aliases_and_sources = sorted(
             aliases_and_sources, key=lambda a_s: SOURCE_PRIORITY.index(a_s[1]))
         for alias, source in sorted_aliases_and_sources:
-            print(f'{protein_id}\t{alias}\t{source}')
+            yield protein_id, alias, source
             break    # ignore all but first
 
 
+def print_aliases(filtered_aliases):
+    for protein_id, alias, source in select_aliases(filtered_aliases):
+        print(f'{protein_id}\t{alias}\t{source}')
+
+
 def main(argv):
     args = argparser().parse_args(argv[1:])
-    filter_protein_aliases(args.file, args)
+    with profiling(args):
+        filter_protein_aliases(args.file, args)
 
 
 if __name__ == '__main__':
@@ -6,27 +6,46 @@ import sys
 
 from argparse import ArgumentParser
 
-from common import DocReader, open_file, load_ids
+from common import DocReader, open_file, load_ids, register_stage
+from common import profiler, profiling, add_profile_arguments
+from common import add_input_arguments, add_output_arguments
+from common import add_shard_arguments, open_sharded_writer
 
 
 def argparser():
     ap = ArgumentParser()
     ap.add_argument('--char-offsets', default=False, action='store_true',
                     help='offsets are character- instead of byte-based')
+    add_input_arguments(ap)
+    add_profile_arguments(ap)
+    add_output_arguments(ap)
+    add_shard_arguments(ap)
     ap.add_argument('docs', help='documents in database_documents.tsv format')
     ap.add_argument('ids', help='text file with document IDs')
     ap.add_argument('out', help='output file')
     return ap
 
 
+@register_stage('filter-ids')
+def filter_ids_stage(ids_fn, options):
+    """Pipeline stage dropping documents with IDs not in ids_fn."""
+    if ids_fn is None:
+        raise ValueError('filter-ids requires argument (filter-ids:FILE)')
+    ids = load_ids(ids_fn, options)
+    def filter_document(doc, spans):
+        return (doc, spans) if doc.id in ids else None
+    return filter_document
+
+
 def filter_documents(doc_fn, out_fn, ids, options):
     out_count = 0
     with open_file(doc_fn, 'r', options) as doc_f:
         doc_reader = DocReader(doc_f)
-        with open_file(out_fn, 'w', options) as out_f:
+        with open_sharded_writer(out_fn, options) as out:
             for doc_idx, doc in enumerate(doc_reader):
                 if doc.id in ids:
-                    print(doc, file=out_f, flush=True)
+                    with profiler.stage('write'):
+                        out.writer(doc.id).write_document(doc)
                     out_count += 1
                 if (doc_idx+1) % 100000 == 0:
                     print(f'processed {doc_idx+1}, output {out_count}',
@@ -37,8 +56,10 @@ def filter_documents(doc_fn, out_fn, ids, options):
 
 def main(argv):
     args = argparser().parse_args(argv[1:])
-    ids = load_ids(args.ids, args)
-    filter_documents(args.docs, args.out, ids, args)
+    with profiling(args):
+        with profiler.stage('load_ids'):
+            ids = load_ids(args.ids, args)
+        filter_documents(args.docs, args.out, ids, args)
     return 0
 
 
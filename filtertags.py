@@ -6,13 +6,20 @@ import sys
 
 from argparse import ArgumentParser
 
-from common import open_file, load_ids
+from common import open_file, load_ids, add_output_arguments
+from common import profiler, profiling, add_profile_arguments
+from common import add_input_arguments
+from common import add_shard_arguments, open_sharded_writer
 
 
 def argparser():
     ap = ArgumentParser()
     ap.add_argument('--char-offsets', default=False, action='store_true',
                     help='offsets are character- instead of byte-based')
+    add_input_arguments(ap)
+    add_profile_arguments(ap)
+    add_output_arguments(ap)
+    add_shard_arguments(ap)
     ap.add_argument('tags', help='tags in all_matches.tsv format')
     ap.add_argument('ids', help='text file with document IDs')
     ap.add_argument('out', help='output file')
@@ -22,12 +29,14 @@ def argparser():
 def filter_tags(tag_fn, out_fn, ids, options):
     out_count = 0
     with open_file(tag_fn, 'r', options) as tag_f:
-        with open_file(out_fn, 'w', options) as out_f:
+        with open_sharded_writer(out_fn, options) as out:
             for ln, line in enumerate(tag_f, start=1):
                 id_ = line.split('\t')[0]
                 if id_ in ids:
-                    print(line, file=out_f, end='')
+                    with profiler.stage('write'):
+                        out.writer(id_).write(line)
                     out_count += 1
+                profiler.count(spans=1, bytes_=len(line))
                 if ln % 100000 == 0:
                     print(f'processed {ln}, output {out_count}',
                           file=sys.stderr)
@@ -37,8 +46,10 @@ def filter_tags(tag_fn, out_fn, ids, options):
 
 def main(argv):
     args = argparser().parse_args(argv[1:])
-    ids = load_ids(args.ids, args)
-    filter_tags(args.tags, args.out, ids, args)
+    with profiling(args):
+        with profiler.stage('load_ids'):
+            ids = load_ids(args.ids, args)
+        filter_tags(args.tags, args.out, ids, args)
     return 0
 
 
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+"""
+Apply a pipeline of document and span transforms in a single pass.
+
+Reads documents in database_documents.tsv format and spans in
+all_matches.tsv format once, applies the given stages to each document
+and its spans, and writes the results. Available stages:
+
+    cut[:CUT]             cut documents and spans (see cuttags.py)
+    filter-ids:FILE       keep documents with IDs in FILE (filterdocs.py)
+    validate              drop spans not matching document text
+    char-to-byte[:ENC]    map character to byte offsets (requires
+                          --char-offsets)
+
+For example, to cut to title and abstract, filter to given IDs and
+validate spans:
+
+    pipeline.py -s cut:tiab -s filter-ids:ids.txt -s validate \
+        docs.tsv tags.tsv out-docs.tsv out-tags.tsv
+"""
+
+import sys
+
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+from common import SpanReader, Pipeline, iter_documents_with_spans
+from common import open_file, open_writer
+from common import profiler, profiling, add_profile_arguments
+from common import add_input_arguments
+from common import add_output_arguments
+
+# Import modules to register their pipeline stages
+import cuttags
+import filterdocs
+import comparespans
+import char_to_byte_offsets
+
+
+def argparser():
+    ap = ArgumentParser(description=__doc__,
+                        formatter_class=RawDescriptionHelpFormatter)
+    ap.add_argument('--char-offsets', default=False, action='store_true',
+                    help='offsets are character- instead of byte-based')
+    ap.add_argument('-s', '--stage', dest='stages', action='append',
+                    default=[], metavar='NAME[:ARG]',
+                    help='pipeline stage (may be repeated, applied in order)')
+    add_input_arguments(ap)
+    add_profile_arguments(ap)
+    add_output_arguments(ap)
+    ap.add_argument('docs', help='documents in database_documents.tsv format')
+    ap.add_argument('tags', help='tagged strings in all_matches.tsv format')
+    ap.add_argument('doc_out', help='output file for documents')
+    ap.add_argument('tag_out', help='output file for tags')
+    return ap
+
+
+def run_pipeline(doc_fn, tag_fn, doc_out_fn, tag_out_fn, pipeline, options):
+    doc_count, out_count = 0, 0
+    with open_file(doc_fn, 'r', options) as doc_f, \
+         open_file(tag_fn, 'r', options) as tag_f, \
+         open_writer(doc_out_fn, options) as doc_out, \
+         open_writer(tag_out_fn, options) as tag_out:
+        span_reader = SpanReader(tag_f, no_type_mapping=True,
+                                 no_norm_filtering=True)
+        documents = iter_documents_with_spans(doc_f, [span_reader])
+        for doc, (spans,) in documents:
+            doc_count += 1
+            result = pipeline(doc, spans)
+            if result is None:
+                continue    # dropped
+            doc, spans = result
+            with profiler.stage('write'):
+                doc_out.write_document(doc)
+                for span in spans:
+                    tag_out.write_span(span)
+            out_count += 1
+    print(f'output {out_count}/{doc_count} documents', file=sys.stderr)
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    pipeline = Pipeline(args.stages, args)
+    with profiling(args):
+        run_pipeline(args.docs, args.tags, args.doc_out, args.tag_out,
+                     pipeline, args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,46 +1,170 @@
 #!/usr/bin/env python3
 
 import sys
+import os
 
+from multiprocessing import Pool
 from argparse import ArgumentParser
 
+from common import profiler, profiling, add_profile_arguments
+from common import open_writer, add_output_arguments, atomic_open, walk_files
+
+
+# Type map and options, set by init_globals() in each process
+TYPE_MAP = None
+OPTIONS = None
+
 
 def argparser():
     ap = ArgumentParser()
+    ap.add_argument('--lowercase', default=False, action='store_true',
+                    help='match texts case-insensitively')
+    output = ap.add_mutually_exclusive_group()
+    output.add_argument('--in-place', default=False, action='store_true',
+                        help='rewrite input files instead of printing')
+    output.add_argument('--output-dir', default=None,
+                        help='write retyped files to directory')
+    ap.add_argument('--jobs', default=1, type=int,
+                    help='number of parallel workers')
+    add_profile_arguments(ap)
+    add_output_arguments(ap)
     ap.add_argument('types', help='TSV with TEXT TYPE' )
-    ap.add_argument('ann', nargs='+', help='standoff annotation')
+    ap.add_argument('ann', nargs='+',
+                    help='standoff annotation(s) or directories of them')
     return ap
 
 
-def retype_standoff(fn, type_map, options):
+def init_globals(type_map, options):
+    """Set globals used by workers (also used as Pool initializer)."""
+    global TYPE_MAP, OPTIONS
+    TYPE_MAP, OPTIONS = type_map, options
+
+
+def retype_lines(lines, type_map, options):
+    """Generate lines with textbound types mapped by type_map."""
+    for line in lines:
+        line = line.rstrip('\n')
+        if not line.startswith('T'):
+            yield line    # echo non-textbounds
+        else:
+            id_, type_span, text = line.split('\t')
+            type_, span = type_span.split(' ', 1)
+            key = text.lower() if options.lowercase else text
+            new_type = type_map.get(key)
+            if new_type is not None and new_type != type_:
+                line = f'{id_}\t{new_type} {span}\t{text}'
+            yield line
+
+
+def retype_standoff(fn, type_map, out, options):
     with open(fn) as f:
-        for ln, line in enumerate(f, start=1):
-            line = line.rstrip('\n')
-            if not line.startswith('T'):
-                print(line)    # echo non-textbounds
-            else:
-                id_, type_span, text = line.split('\t')
-                type_, span = type_span.split(' ', 1)
-                if text in type_map and type_map[text] != type_:
-                    line = f'{id_}\t{type_map[text]} {span}\t{text}'
-                print(line)
+        for line in retype_lines(f, type_map, options):
+            out.write_line(line)
+
+
+def output_paths(inputs, options):
+    """Return list of (input, output) paths for (input, relative path)
+    pairs, raising ValueError if two inputs have the same output."""
+    paths, seen = [], {}
+    for fn, rel_path in inputs:
+        if options.in_place:
+            out_fn = fn
+        else:
+            out_fn = os.path.join(options.output_dir, rel_path)
+        out_fn = os.path.normpath(out_fn)
+        if out_fn in seen:
+            raise ValueError(f'{seen[out_fn]} and {fn} would both be '
+                             f'written to {out_fn}')
+        seen[out_fn] = fn
+        paths.append((fn, out_fn))
+    return paths
+
+
+def retype_file(paths):
+    """Retype input to output path, given as a pair (worker function)."""
+    fn, out_fn = paths
+    with open(fn) as f:
+        lines = list(retype_lines(f, TYPE_MAP, OPTIONS))
+    os.makedirs(os.path.dirname(out_fn) or '.', exist_ok=True)
+    with atomic_open(out_fn, 'w') as out:
+        for line in lines:
+            print(line, file=out)
+
+
+def retype_text(fn):
+    """Return retyped content of fn (worker function)."""
+    with open(fn) as f:
+        return ''.join(
+            line + '\n' for line in retype_lines(f, TYPE_MAP, OPTIONS))
+
 
-                    
 def load_type_map(fn, options):
     type_map = {}
     with open(fn) as f:
         for ln, l in enumerate(f, start=1):
             text, type_ = l.rstrip('\n').split('\t')
-            assert text not in type_map, f'duplicate: {text}'
+            if options.lowercase:
+                text = text.lower()
+                if type_map.get(text, type_) != type_:
+                    raise ValueError(f'conflicting types for {text} on line '
+                                     f'{ln} in {fn}')
+            else:
+                assert text not in type_map, f'duplicate: {text}'
             type_map[text] = type_
     return type_map
 
-            
+
+def input_paths(paths):
+    """Generate (path, relative path) for input files, the latter
+    relative to the directory given in paths (base name for files)."""
+    for path in paths:
+        if os.path.isdir(path):
+            for fn in walk_files(path, '.ann'):
+                yield fn, os.path.relpath(fn, path)
+        else:
+            yield path, os.path.basename(path)
+
+
 def main(argv):
     args = argparser().parse_args(argv[1:])
-    type_map = load_type_map(args.types, args)
-    for fn in args.ann:
-        retype_standoff(fn, type_map, args)
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+    with profiling(args):
+        with profiler.stage('load_types'):
+            type_map = load_type_map(args.types, args)
+        init_globals(type_map, args)
+        inputs = input_paths(args.ann)
+        if args.jobs > 1:
+            pool = Pool(args.jobs, init_globals, (type_map, args))
+        else:
+            pool = None
+        try:
+            if args.in_place or args.output_dir is not None:
+                paths = output_paths(inputs, args)
+                with profiler.stage('retype'):
+                    if pool is not None:
+                        results = pool.imap_unordered(retype_file, paths, 64)
+                    else:
+                        results = map(retype_file, paths)
+                    for result in results:
+                        profiler.count(docs=1)
+            else:
+                fns = (fn for fn, _ in inputs)
+                with open_writer('-', args, encoding='utf-8') as out:
+                    if pool is not None:
+                        # ordered, preserving input order on stdout
+                        for text in pool.imap(retype_text, fns, 64):
+                            out.write(text)
+                            profiler.count(docs=1)
+                    else:
+                        for fn in fns:
+                            with profiler.stage('retype'):
+                                retype_standoff(fn, type_map, out, args)
+                            profiler.count(docs=1)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
     return 0
 
 
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+"""Index sections of STRING DB database_documents.tsv format.
+
+Writes for each document its ID and the comma-separated end offsets
+of its tab-separated sections, for use with the --section-index
+option of cutdocuments.py and cuttags.py.
+
+Building the index takes a full pass over the documents, and tools
+using it still read the documents in full and check each against the
+index; the index only saves searching document texts for section
+boundaries. It therefore does not pay off for a single run, only when
+the same index is reused for several cuts of the same documents. The
+index is not updated or reused automatically: rebuild it when the
+documents change (a stale index is reported as an error).
+"""
+
+import sys
+
+from argparse import ArgumentParser
+
+from common import DocReader, open_file
+from common import profiler, profiling, add_profile_arguments
+from common import add_input_arguments
+from cutdocuments import section_offsets
+
+
+def argparser():
+    ap = ArgumentParser()
+    ap.add_argument('--char-offsets', default=False, action='store_true',
+                    help='offsets are character- instead of byte-based')
+    add_input_arguments(ap)
+    add_profile_arguments(ap)
+    ap.add_argument('docs', help='documents in database_documents.tsv format')
+    ap.add_argument('out', help='output file for section index')
+    return ap
+
+
+def index_sections(doc_fn, out_fn, options):
+    doc_count, section_count = 0, 0
+    with open_file(doc_fn, 'r', options) as doc_f:
+        with open_file(out_fn, 'w', options) as out_f:
+            for doc in DocReader(doc_f):
+                with profiler.stage('index'):
+                    sections = section_offsets(doc.text)
+                ends = ','.join(str(end) for start, end in sections)
+                print(f'{doc.id}\t{ends}', file=out_f)
+                doc_count += 1
+                section_count += len(sections)
+    print(f'indexed {section_count} sections in {doc_count} documents',
+          file=sys.stderr)
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    with profiling(args):
+        index_sections(args.docs, args.out, args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
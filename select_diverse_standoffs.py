@@ -2,22 +2,41 @@
 
 """
 Select standoffs containing at least one new annotated textbound name.
+
+By default, considers standoffs in random order and skips those with
+mostly known or common names. With --mode coverage, greedily selects
+the standoff adding the most new names (per textbound with --budget)
+until --count standoffs are selected, the budget is used or no new
+names remain, using lazy re-evaluation of gains (CELF).
 """
 
 import sys
 import os
+import heapq
 
 from glob import glob
-from random import shuffle
+from random import shuffle, seed
 from collections import namedtuple, Counter
-from argparse import ArgumentParser
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+from common import profiler, profiling, add_profile_arguments
 
 
 Textbound = namedtuple('Textbound', 'id type start end text')
 
 
 def argparser():
-    ap = ArgumentParser()
+    ap = ArgumentParser(description=__doc__,
+                        formatter_class=RawDescriptionHelpFormatter)
+    ap.add_argument('--mode', choices=['shuffle', 'coverage'],
+                    default='shuffle', help='selection mode')
+    ap.add_argument('--count', default=None, type=int,
+                    help='number of standoffs to select (coverage mode)')
+    ap.add_argument('--budget', default=None, type=int,
+                    help='total textbounds in selected standoffs (coverage '
+                    'mode)')
+    ap.add_argument('--seed', default=None, type=int, help='random seed')
+    add_profile_arguments(ap)
     ap.add_argument('dir')
     return ap
 
@@ -45,18 +64,74 @@ def known_name_ratio(overall_counts, names):
     return len([t for t in names if t in known_names]) / len(names)
 
 
-def main(argv):
-    args = argparser().parse_args(argv[1:])
-
+def select_standoffs(args):
     files = glob(os.path.join(args.dir, '*.ann'))
 
     textbounds_by_path = {}
-    for fn in files:
-        textbounds_by_path[fn] = load_textbounds(fn, args)
+    with profiler.stage('read'):
+        for fn in files:
+            textbounds_by_path[fn] = load_textbounds(fn, args)
+            profiler.count(docs=1, spans=len(textbounds_by_path[fn]))
+
+    if args.mode == 'coverage':
+        with profiler.stage('select'):
+            select_coverage(sorted(files), textbounds_by_path, args)
+        return
 
     seen, counts = set(), Counter()
     shuffled_files = list(files)
+    seed(args.seed)
     shuffle(shuffled_files)
+    with profiler.stage('select'):
+        select_shuffled(shuffled_files, textbounds_by_path, seen, counts)
+    print(counts.most_common(100), file=sys.stderr)
+
+
+def select_coverage(files, textbounds_by_path, options):
+    """Greedy max-coverage of lowercased names with lazy evaluation."""
+    names = {}
+    heap = []    # (-priority, file index, selection round of priority)
+    for i, fn in enumerate(files):
+        names[fn] = frozenset(t.text.lower() for t in textbounds_by_path[fn])
+        heap.append((-priority(len(names[fn]), fn, textbounds_by_path,
+                               options), i, 0))
+    heapq.heapify(heap)
+    covered, selected, cost = set(), 0, 0
+    while heap and (options.count is None or selected < options.count):
+        neg_priority, i, round_ = heapq.heappop(heap)
+        fn = files[i]
+        if round_ != selected:
+            # gains only decrease as coverage grows (submodularity), so
+            # re-evaluated priority is an upper bound for later rounds
+            gain = len(names[fn] - covered)
+            if gain > 0:
+                heapq.heappush(heap, (
+                    -priority(gain, fn, textbounds_by_path, options), i,
+                    selected))
+            continue
+        if neg_priority >= 0:
+            break    # no new names left
+        fn_cost = len(textbounds_by_path[fn])
+        if options.budget is not None and cost + fn_cost > options.budget:
+            continue    # does not fit, try others
+        print(fn)
+        covered.update(names[fn])
+        selected += 1
+        cost += fn_cost
+    all_names = set().union(*names.values())
+    print(f'selected {selected}/{len(files)} standoffs with {cost} '
+          f'textbounds covering {len(covered)}/{len(all_names)} names',
+          file=sys.stderr)
+
+
+def priority(gain, fn, textbounds_by_path, options):
+    if options.budget is None:
+        return gain
+    else:
+        return gain / max(1, len(textbounds_by_path[fn]))
+
+
+def select_shuffled(shuffled_files, textbounds_by_path, seen, counts):
     for fn in shuffled_files:
         lc_names = [t.text.lower() for t in textbounds_by_path[fn]]
         unseen_lc_names = set(lc_names) - seen
@@ -70,7 +145,12 @@ def main(argv):
             print(fn)    # OK
             seen.update(lc_names)
             counts.update(lc_names)
-    print(counts.most_common(100), file=sys.stderr)
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    with profiling(args):
+        select_standoffs(args)
     return 0
 
 
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+"""
+Sort STRING DB all_matches.tsv format by document, start and end.
+
+Performs an external merge sort with bounded memory: the inputs are
+split into byte ranges that are read by parallel workers, each of
+which writes sorted runs to temporary files that are then merged.
+Documents are ordered as in database_documents.tsv if given, otherwise
+by document ID. The sort is stable and independent of locale.
+"""
+
+import sys
+import os
+import shutil
+import tempfile
+
+from multiprocessing import Pool
+from argparse import ArgumentParser
+
+from common import DocReader, doc_id_key, encoding_args, open_file
+from common import write_run, merge_runs
+from common import profiler, profiling, add_profile_arguments
+
+
+# Document order and options, set by init_globals() in each process
+DOC_ORDER = None
+OPTIONS = None
+
+
+def argparser():
+    ap = ArgumentParser()
+    ap.add_argument('--char-offsets', default=False, action='store_true',
+                    help='offsets are character- instead of byte-based')
+    ap.add_argument('--docs', default=None,
+                    help='order documents as in this database_documents.tsv')
+    ap.add_argument('--jobs', default=os.cpu_count(), type=int,
+                    help='number of parallel workers')
+    ap.add_argument('--buffer-size', default=256, type=int, metavar='MB',
+                    help='memory for in-memory runs per worker')
+    ap.add_argument('--tmpdir', default=None,
+                    help='directory for temporary files')
+    add_profile_arguments(ap)
+    ap.add_argument('tags', nargs='+', help='tags in all_matches.tsv format')
+    ap.add_argument('out', help='output file')
+    return ap
+
+
+def init_globals(doc_order, options):
+    """Set globals used by span_sort_key() and workers (also used as
+    Pool initializer)."""
+    global DOC_ORDER, OPTIONS
+    DOC_ORDER, OPTIONS = doc_order, options
+
+
+def load_doc_order(doc_fn, options):
+    doc_order = {}
+    with open_file(doc_fn, 'r', options) as doc_f:
+        for doc_idx, doc_id in enumerate(DocReader(doc_f).document_ids()):
+            doc_order[doc_id] = doc_idx
+    print(f'read order of {len(doc_order)} documents from {doc_fn}',
+          file=sys.stderr)
+    return doc_order
+
+
+def span_sort_key(line):
+    doc_id, _, _, start, end = line.split('\t', 5)[:5]
+    if DOC_ORDER is None:
+        return (doc_id_key(doc_id), int(start), int(end))
+    else:
+        # documents missing from DOC_ORDER go last, ordered by ID
+        doc_idx = DOC_ORDER.get(doc_id, len(DOC_ORDER))
+        return ((doc_idx, doc_id_key(doc_id)), int(start), int(end))
+
+
+def split_ranges(fn, parts):
+    """Split file into at most parts byte ranges at line boundaries."""
+    size = os.path.getsize(fn)
+    boundaries = [0]
+    with open(fn, 'rb') as f:
+        for i in range(1, parts):
+            f.seek(max(size * i // parts, boundaries[-1]))
+            f.readline()
+            boundaries.append(min(f.tell(), size))
+    boundaries.append(size)
+    return [
+        (fn, start, end) for start, end in zip(boundaries, boundaries[1:])
+        if start < end
+    ]
+
+
+def read_range(fn, start, end):
+    """Return lines in byte range [start, end) of file."""
+    encoding = encoding_args(OPTIONS)
+    with open(fn, 'rb') as f:
+        f.seek(start)
+        offset = start
+        while offset < end:
+            line = f.readline()
+            if not line:
+                break
+            offset += len(line)
+            if not line.endswith(b'\n'):
+                line += b'\n'
+            yield line.decode(**encoding)
+
+
+def write_sorted_run(lines, run_dir):
+    try:
+        lines.sort(key=span_sort_key)
+    except Exception as e:
+        raise ValueError(f'failed to sort: {e}')
+    return write_run(lines, OPTIONS, run_dir)
+
+
+def sort_range(range_, run_dir):
+    """Sort byte range of file into runs, return run paths."""
+    buffer_size = OPTIONS.buffer_size * 2**20
+    runs, buffer, size = [], [], 0
+    for line in read_range(*range_):
+        buffer.append(line)
+        size += len(line)
+        if size >= buffer_size:
+            runs.append(write_sorted_run(buffer, run_dir))
+            buffer, size = [], 0
+    if buffer:
+        runs.append(write_sorted_run(buffer, run_dir))
+    return runs
+
+
+def sort_tags(tag_fns, out_fn, options):
+    doc_order = None
+    if options.docs is not None:
+        doc_order = load_doc_order(options.docs, options)
+    init_globals(doc_order, options)
+    ranges = []
+    for tag_fn in tag_fns:
+        ranges.extend(split_ranges(tag_fn, options.jobs))
+    run_dir = tempfile.mkdtemp(prefix='sorttags-', dir=options.tmpdir)
+    try:
+        with profiler.stage('sort'), \
+             Pool(options.jobs, init_globals, (doc_order, options)) as pool:
+            range_runs = pool.starmap(
+                sort_range, [(range_, run_dir) for range_ in ranges])
+        runs = [run for r in range_runs for run in r]
+        print(f'merging {len(runs)} sorted runs', file=sys.stderr)
+        with profiler.stage('merge'), \
+             open_file(out_fn, 'w', options) as out_f:
+            out_f.writelines(merge_runs(runs, span_sort_key, options, run_dir))
+    finally:
+        shutil.rmtree(run_dir)
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    with profiling(args):
+        sort_tags(args.tags, args.out, args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
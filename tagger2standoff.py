@@ -3,11 +3,13 @@
 import sys
 import os
 
-from collections import defaultdict
 from argparse import ArgumentParser
 from logging import error
 
-from common import DocReader, SpanReader, open_file
+from common import SpanReader, iter_documents_with_spans, deduplicate_spans
+from common import AliasIndex, open_file, open_writer
+from common import profiler, profiling, add_profile_arguments
+from common import add_input_arguments
 
 
 # Placeholder value for missing norm IDs
@@ -18,6 +20,14 @@ def argparser():
     ap = ArgumentParser()
     ap.add_argument('--char-offsets', default=False, action='store_true',
                     help='offsets are character- instead of byte-based')
+    ap.add_argument('--only-changed', default=None, metavar='DIFF',
+                    help='only convert documents listed in DIFF (output '
+                    'of difftags.py)')
+    ap.add_argument('--aliases', default=None, metavar='INDEX',
+                    help='add names from alias index to normalizations '
+                    '(see filter_protein_aliases.py --index)')
+    add_input_arguments(ap)
+    add_profile_arguments(ap)
     ap.add_argument('docs', help='documents in database_documents.tsv format')
     ap.add_argument('tags', help='tagged strings in all_matches.tsv format')
     ap.add_argument('dir', help='output directory')
@@ -53,61 +63,70 @@ def normalize_type(type_):
     return type_
 
 
-def deduplicate_spans(spans, options):
-    """Combine serials and sources for spans with identical boundaries and
-    types."""
-    make_key = lambda s: (s.start, s.end, s.type)
-    span_map = defaultdict(list)
-    deduped = []
-    for span in spans:
-        key = make_key(span)
-        span.sources = set([span.source])
-        if key not in span_map:
-            deduped.append(span)
-        else:
-            span_map[key][0].serials.extend(span.serials)
-            span_map[key][0].sources.update(span.sources)
-        span_map[key].append(span)
-    for span in spans:
-        span.source = ','.join(sorted(span.sources))
-    return deduped
-
-
-def convert_single(doc, spans, out_dir, options):
+def convert_single(doc, spans, out_dir, options, aliases=None):
     for span in spans:
         span.type = normalize_type(span.type)
-    spans = deduplicate_spans(spans, options)
-    with open_file(os.path.join(out_dir, f'{doc.id}.txt'), 'w', options) as f:
-        print(doc.text.replace('\t', '\n'), file=f)
-    offset_map = make_offset_map(doc.text)
-    with open_file(os.path.join(out_dir, f'{doc.id}.ann'), 'w', options) as f:
+    spans = deduplicate_spans(spans, merge_sources=True)
+    with profiler.stage('write'):
+        with open_writer(os.path.join(out_dir, f'{doc.id}.txt'),
+                         options) as f:
+            f.write_line(doc.text.replace('\t', '\n'))
+    with profiler.stage('offset_map'):
+        offset_map = make_offset_map(doc.text)
+    with profiler.stage('write'), \
+         open_writer(os.path.join(out_dir, f'{doc.id}.ann'), options) as f:
         n = 1
         for i, span in enumerate(spans, start=1):
             s, e = span.start, span.end+1    # end-exclusive
             s, e = offset_map[s], offset_map[e]    # char offsets
-            if len(span.sources) == 2:    # assume two sources
+            if len(span.source.split(',')) == 2:    # assume two sources
                 t = f'{span.type}'
             else:
                 t = f'{span.type}-{span.source}'
-            print(f'T{i}\t{t} {s} {e}\t{span.text}', file=f)
+            f.write(f'T{i}\t{t} {s} {e}\t{span.text}\n')
             for serial in span.serials:
-                if serial != DUMMY_SERIAL:
-                    print(f'N{n}\tReference T{i} string:{serial}',
-                          file=f)
-                    n += 1
-
-
-def convert_to_standoff(doc_fn, tag_fn, out_dir, options):
+                if serial == DUMMY_SERIAL:
+                    continue
+                name = aliases.get(serial) if aliases is not None else None
+                if name is None:
+                    f.write(f'N{n}\tReference T{i} string:{serial}\n')
+                else:
+                    f.write(f'N{n}\tReference T{i} string:{serial}\t{name}\n')
+                n += 1
+
+
+def load_changed_ids(fn, options):
+    ids = set()
+    with open_file(fn, 'r', options) as f:
+        for line in f:
+            ids.add(line.split('\t', 1)[0].rstrip('\n'))
+    print(f'read {len(ids)} changed document ids from {fn}', file=sys.stderr)
+    return ids
+
+
+def changed_documents(doc_f, span_reader, options):
+    """Generate (doc, [spans]) for documents listed in options.only_changed,
+    parsing only their spans."""
+    ids = load_changed_ids(options.only_changed, options)
+    documents = iter_documents_with_spans(doc_f, [span_reader], parse=False)
+    for doc, (lines,) in documents:
+        if doc.id in ids:
+            yield doc, [span_reader.parse_lines(lines)]
+
+
+def convert_to_standoff(doc_fn, tag_fn, out_dir, options, aliases=None):
     NOTE_TYPE = 'AnnotatorNotes'
     with open_file(doc_fn, 'r', options) as doc_f:
-        doc_reader = DocReader(doc_f)
         with open_file(tag_fn, 'r', options) as tag_f:
             # Read spans that include source information
             span_reader = SpanReader(tag_f, source=True)
-            for doc in doc_reader:
-                spans = list(span_reader.document_spans(doc.id))
+            if options.only_changed is None:
+                documents = iter_documents_with_spans(doc_f, [span_reader])
+            else:
+                documents = changed_documents(doc_f, span_reader, options)
+            for doc, (spans,) in documents:
                 try:
-                    convert_single(doc, spans, out_dir, options)
+                    convert_single(doc, spans, out_dir, options, aliases)
                 except Exception as e:
                     error(f'failed to convert {doc.id}: {e}')
                     raise
@@ -115,7 +134,13 @@ def convert_to_standoff(doc_fn, tag_fn, out_dir, options):
 
 def main(argv):
     args = argparser().parse_args(argv[1:])
-    convert_to_standoff(args.docs, args.tags, args.dir, args)
+    with profiling(args):
+        if args.aliases is None:
+            convert_to_standoff(args.docs, args.tags, args.dir, args)
+        else:
+            with AliasIndex(args.aliases) as aliases:
+                convert_to_standoff(args.docs, args.tags, args.dir, args,
+                                    aliases)
     return 0
 
 
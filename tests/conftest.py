@@ -0,0 +1,27 @@
+import os
+import sys
+import subprocess
+
+from argparse import Namespace
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import benchmark
+
+
+@pytest.fixture(scope='session')
+def corpus(tmp_path_factory):
+    """Directory with small synthetic corpus (see benchmark.py)."""
+    dir_ = str(tmp_path_factory.mktemp('corpus'))
+    benchmark.generate_corpus(dir_, Namespace(seed=0, docs=50))
+    return dir_
+
+
+def run_tool(script, *args, cwd=None):
+    """Run script from the repository, return completed process."""
+    return subprocess.run(
+        [sys.executable, os.path.join(REPO_DIR, script), *map(str, args)],
+        cwd=cwd, capture_output=True, text=True, check=True)
@@ -0,0 +1,18 @@
+import os
+import json
+
+from conftest import run_tool
+
+
+def test_read_ahead_profile_includes_tag_files(corpus, tmp_path):
+    profile = tmp_path / 'profile.json'
+    inputs = [
+        os.path.join(corpus, fn) for fn in
+        ('database_documents.tsv', 'all_matches.tsv', 'all_matches2.tsv')
+    ]
+    run_tool('comparespans.py', '--read-ahead', '--profile',
+             '--profile-output', profile,
+             '--output', tmp_path / 'results.txt', *inputs, cwd=tmp_path)
+    metrics = json.loads(profile.read_text())['metrics']
+    for fn in inputs:
+        assert metrics[f'read_ahead {fn}']['batches'] > 0
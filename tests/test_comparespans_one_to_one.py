@@ -0,0 +1,54 @@
+import pytest
+
+import benchmark
+import comparespans
+
+from common import StringSpan
+
+
+def span(start, end, text, source, type_='Chemical'):
+    return StringSpan('1', '1', '1', start, end, text, type_, 'CIDs00000001',
+                      source, no_type_mapping=True)
+
+
+def overlaps(args, spans1, spans2):
+    options = comparespans.argparser().parse_args(args + ['docs', 'tags'])
+    stats = comparespans.compare_document_spans(
+        '1', 'a', 'b', spans1, spans2, options)
+    return dict(stats.overlap_by_source_and_text[('a', 'b')])
+
+
+def test_overlap_with_exactly_matched_span():
+    spans1 = [span(0, 9, 'x', 'a')]
+    spans2 = [span(0, 9, 'y', 'b'), span(2, 6, 'z', 'b'),
+              span(0, 4, 'w', 'b', 'Gene')]
+    expected = {'x\tz': 1}
+    assert overlaps([], spans1, spans2) == expected
+    assert overlaps(['--one-to-one'], spans1, spans2) == expected
+
+
+def test_one_to_one_overlap_losers():
+    spans1 = [span(0, 9, 'x', 'a')]
+    spans2 = [span(1, 8, 'y', 'b'), span(2, 6, 'z', 'b')]
+    assert overlaps(['--one-to-one', '--overlap'], spans1, spans2) == {
+        'x\tz': 1
+    }
+
+
+def test_nested_spans_agree_with_default():
+    rng = benchmark.random.Random(1)
+    spans1 = benchmark.nested_spans('1', 'a', rng)
+    spans2 = benchmark.nested_spans('1', 'b', rng)
+    benchmark.check_one_to_one_spans('1', spans1, spans2)
+
+
+def test_corpus_agrees_with_default(corpus):
+    benchmark.check_one_to_one(corpus)
+
+
+def test_check_detects_difference():
+    # duplicate spans match twice in the default comparison
+    spans1 = [span(0, 9, 'x', 'a')]
+    spans2 = [span(0, 9, 'y', 'b'), span(0, 9, 'y', 'b')]
+    with pytest.raises(AssertionError):
+        benchmark.check_one_to_one_spans('1', spans1, spans2, nested=False)
@@ -0,0 +1,24 @@
+import os
+
+from conftest import run_tool
+
+
+def test_pipeline_matches_chained_tools(corpus, tmp_path):
+    docs = os.path.join(corpus, 'database_documents.tsv')
+    tags = os.path.join(corpus, 'all_matches.tsv')
+    ids = tmp_path / 'ids.txt'
+    with open(docs) as f:
+        ids.write_text(''.join(
+            line.split('\t', 1)[0] + '\n'
+            for i, line in enumerate(f) if i % 2 == 0))
+
+    run_tool('cuttags.py', '--cut', 'tiab', '--doc-out', tmp_path / 'cd.tsv',
+             docs, tags, tmp_path / 'ct.tsv')
+    run_tool('filterdocs.py', tmp_path / 'cd.tsv', ids, tmp_path / 'd.tsv')
+    run_tool('filtertags.py', tmp_path / 'ct.tsv', ids, tmp_path / 't.tsv')
+    run_tool('pipeline.py', '-s', 'cut:tiab', '-s', f'filter-ids:{ids}',
+             docs, tags, tmp_path / 'pd.tsv', tmp_path / 'pt.tsv')
+
+    for out, chained in (('pd.tsv', 'd.tsv'), ('pt.tsv', 't.tsv')):
+        assert ((tmp_path / out).read_bytes() ==
+                (tmp_path / chained).read_bytes())
@@ -0,0 +1,28 @@
+import multiprocessing
+
+import pytest
+
+import retype_standoff
+
+
+@pytest.fixture
+def spawn():
+    method = multiprocessing.get_start_method()
+    multiprocessing.set_start_method('spawn', force=True)
+    yield
+    multiprocessing.set_start_method(method, force=True)
+
+
+def test_retype_with_spawned_workers(tmp_path, spawn):
+    types = tmp_path / 'types.tsv'
+    types.write_text('BRCA1\tProtein\n')
+    for name in ('a', 'b'):
+        (tmp_path / 'in' / name).mkdir(parents=True)
+        (tmp_path / 'in' / name / 'x.ann').write_text(
+            'T1\tGene 0 5\tBRCA1\nT2\tGene 6 10\tTP53\n')
+    retype_standoff.main(['retype_standoff.py', '--jobs', '2',
+                          '--output-dir', str(tmp_path / 'out'),
+                          str(types), str(tmp_path / 'in')])
+    for name in ('a', 'b'):
+        assert (tmp_path / 'out' / name / 'x.ann').read_text() == (
+            'T1\tProtein 0 5\tBRCA1\nT2\tGene 6 10\tTP53\n')
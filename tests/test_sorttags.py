@@ -0,0 +1,25 @@
+import os
+import multiprocessing
+
+import pytest
+
+import sorttags
+
+
+@pytest.fixture
+def spawn():
+    method = multiprocessing.get_start_method()
+    multiprocessing.set_start_method('spawn', force=True)
+    yield
+    multiprocessing.set_start_method(method, force=True)
+
+
+def test_sort_with_spawned_workers(corpus, tmp_path, spawn):
+    docs = os.path.join(corpus, 'database_documents.tsv')
+    tags = os.path.join(corpus, 'all_matches.tsv')
+    out = tmp_path / 'sorted.tsv'
+    sorttags.main(['sorttags.py', '--jobs', '2', '--docs', docs, tags,
+                   str(out)])
+    with open(tags, encoding='utf-8') as f:
+        expected = f.readlines()
+    assert out.read_text(encoding='utf-8').splitlines(True) == expected
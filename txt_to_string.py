@@ -4,21 +4,40 @@ import sys
 import os
 import re
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from logging import error
 from argparse import ArgumentParser
 
 from common import stringdb_escape_text
+from common import profiler, profiling, add_profile_arguments
+from common import open_writer, add_output_arguments, walk_files
+
+
+REGULAR_ID_RE = re.compile(r'[0-9]+')
 
 
 def argparser():
     ap = ArgumentParser()
     ap.add_argument('--force', action='store_true')
-    ap.add_argument('txt', nargs='+', help='plain text file(s)')
+    ap.add_argument('--file-list', default=None, metavar='FILE',
+                    help='read paths from FILE, one per line ("-" for stdin)')
+    ap.add_argument('--suffix', default='.txt',
+                    help='suffix of files to read from directories')
+    ap.add_argument('--sort', choices=['none', 'name', 'numeric'],
+                    default='none',
+                    help='output order (default: order of paths given)')
+    ap.add_argument('--jobs', default=8, type=int,
+                    help='number of threads reading files')
+    add_profile_arguments(ap)
+    add_output_arguments(ap)
+    ap.add_argument('txt', nargs='*',
+                    help='plain text file(s) or directories of them')
     return ap
 
 
 def is_regular_id(id_):
-    return re.match(r'^[0-9]+$', id_) is not None
+    return REGULAR_ID_RE.fullmatch(id_) is not None
 
 
 def escape_text(text):
@@ -27,27 +46,90 @@ def escape_text(text):
     return text
 
 
-def main(argv):
-    args = argparser().parse_args()
-
-    for fn in args.txt:
-        with open(fn) as f:
-            text = f.read().rstrip()
-
-        id_ = os.path.splitext(os.path.basename(fn))[0]
-
-        if not is_regular_id(id_) and not args.force:
+def file_id(fn):
+    return os.path.splitext(os.path.basename(fn))[0]
+
+
+def numeric_id_key(fn):
+    id_ = file_id(fn)
+    return (0, int(id_), '') if is_regular_id(id_) else (1, 0, id_)
+
+
+def input_paths(options):
+    """Generate paths given as arguments, in file lists and directories."""
+    paths = options.txt
+    if options.file_list is not None:
+        if options.file_list == '-':
+            listed = list(sys.stdin)
+        else:
+            with open(options.file_list) as list_f:
+                listed = list(list_f)
+        paths = paths + [line.rstrip('\n') for line in listed if line.strip()]
+    for path in paths:
+        if os.path.isdir(path):
+            yield from walk_files(path, options.suffix)
+        else:
+            yield path
+
+
+def read_text(fn):
+    with open(fn) as f:
+        return f.read().rstrip()
+
+
+def read_texts(fns, jobs):
+    """Generate (fn, text) in order of fns, reading files in parallel."""
+    with ThreadPoolExecutor(jobs) as executor:
+        pending = deque()
+        for fn in fns:
+            pending.append((fn, executor.submit(read_text, fn)))
+            if len(pending) >= jobs * 4:
+                fn, future = pending.popleft()
+                yield fn, future.result()
+        while pending:
+            fn, future = pending.popleft()
+            yield fn, future.result()
+
+
+def txt_to_string(fns, options):
+    if options.sort == 'name':
+        fns = sorted(fns)
+    elif options.sort == 'numeric':
+        fns = sorted(fns, key=numeric_id_key)
+    else:
+        fns = list(fns)
+    # check filenames before reading or writing anything
+    for fn in fns:
+        if not is_regular_id(file_id(fn)) and not options.force:
             error(f'unexpected filename {fn} (consider --force?)')
             return -1
+    with open_writer('-', options, encoding='utf-8') as out:
+        texts = read_texts(fns, options.jobs)
+        while True:
+            with profiler.stage('read'):
+                fn, text = next(texts, (None, None))
+            if fn is None:
+                break
+            id_ = file_id(fn)
+            with profiler.stage('write'):
+                out.write_line('\t'.join([
+                    id_,
+                    f'PMID:{id_}',
+                    'AUTHORS',
+                    'FORUM',
+                    'YEAR',
+                    escape_text(text)
+                ]))
+            profiler.count(docs=1, bytes_=len(text))
+    return 0
 
-        print('\t'.join([
-            id_,
-            f'PMID:{id_}',
-            'AUTHORS',
-            'FORUM',
-            'YEAR',
-            escape_text(text)
-        ]))
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    if not args.txt and args.file_list is None:
+        argparser().error('no input files')
+    with profiling(args):
+        return txt_to_string(input_paths(args), args)
 
 
 if __name__ == '__main__':